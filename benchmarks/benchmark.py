@@ -0,0 +1,273 @@
+"""Benchmark transfer.py against local fake IMAP servers.
+
+Builds synthetic mailboxes, then runs the transfer, backup and restore modes of transfer.py end to end
+(answering its prompts) and reports messages/s, MB/s, IMAP round trips per message and the peak memory
+of the transfer.py process. Results can be saved and compared with an earlier run to catch regressions:
+
+    python benchmarks/benchmark.py --messages 2000 --latency 0.005 --save baseline.json
+    python benchmarks/benchmark.py --messages 2000 --latency 0.005 --baseline baseline.json
+"""
+import argparse
+import builtins
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import traceback
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from fake_imap import FakeIMAPServer
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Source and destination are told apart by host name; both resolve to this machine
+SOURCE_HOST = "127.0.0.1"
+DEST_HOST = "localhost"
+USERNAME = "bench"
+RESTORE_USERNAME = "restore"
+PASSWORD = "secret"
+BACKUP_PASSWORD = "backup-secret"
+
+MAILBOXES = ["INBOX", "Sent", "Archive", "Projects", "Newsletters"]
+
+# Message shapes and how often each occurs in a profile
+PROFILES = {
+    "mixed": [("text", 0.65), ("html", 0.25), ("attachment", 0.09), ("large", 0.01)],
+    "text": [("text", 1.0)],
+    "attachments": [("text", 0.5), ("attachment", 0.5)],
+    "large": [("large", 1.0)],
+}
+
+WORDS = ("the of and to in is for on that with this as are be at by from meeting project report update please "
+         "review attached thanks regards schedule budget invoice customer release version deadline server "
+         "account team quarter results draft proposal feedback").split()
+
+
+def random_text(rng, size):
+    """Plain text of about *size* bytes, in lines of random words."""
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + "."
+        lines.append(line)
+        length += len(line) + 2
+    return "\r\n".join(lines) + "\r\n"
+
+
+def build_message(rng, index, shape):
+    """Return the raw bytes of one synthetic message of the given shape."""
+    if shape == "text":
+        message = MIMEText(random_text(rng, rng.randint(1000, 8000)))
+    elif shape == "html":
+        message = MIMEMultipart("alternative")
+        text = random_text(rng, rng.randint(2000, 10000))
+        message.attach(MIMEText(text))
+        message.attach(MIMEText("<html><body><p>" + text.replace("\r\n", "</p><p>") + "</p></body></html>", "html"))
+    else:
+        message = MIMEMultipart()
+        message.attach(MIMEText(random_text(rng, rng.randint(500, 3000))))
+        size = rng.randint(50_000, 500_000) if shape == "attachment" else rng.randint(1_000_000, 3_000_000)
+        attachment = MIMEApplication(rng.randbytes(size), Name=f"file{index}.bin")
+        attachment["Content-Disposition"] = f'attachment; filename="file{index}.bin"'
+        message.attach(attachment)
+    message["From"] = "sender@example.com"
+    message["To"] = "bench@example.com"
+    message["Subject"] = f"Benchmark message {index} ({shape})"
+    message["Message-ID"] = f"<bench{index}@example.com>"
+    return message.as_bytes().replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+def populate(account, count, mailboxes, profile, seed):
+    """Fill the account's mailboxes with *count* messages. Returns the total size in bytes."""
+    rng = random.Random(seed)
+    shapes, weights = zip(*PROFILES[profile])
+    total_bytes = 0
+    for index in range(count):
+        raw = build_message(rng, index, rng.choices(shapes, weights)[0])
+        flags = [r"\Seen"] if rng.random() < 0.7 else []
+        account.mailbox(mailboxes[index % len(mailboxes)]).add(raw, flags)
+        total_bytes += len(raw)
+    return total_bytes
+
+
+def peak_rss_bytes():
+    """Peak resident memory of this process, or None where it cannot be measured."""
+    # On Linux ru_maxrss keeps the peak of the process that started us across exec, so the memory of the
+    # fake mailboxes would be counted; VmHWM starts afresh with the new program
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_client(answers, endpoints, workdir, verbose, results):
+    """Child process: run transfer.py's main() with scripted answers and report its time and peak memory."""
+    sys.path.insert(0, REPO_DIR)
+    import transfer
+
+    transfer.connection_endpoints.update(endpoints)
+    answers = iter(answers)
+    builtins.input = lambda prompt="": next(answers)
+    transfer.getpass = lambda prompt="": next(answers)
+    os.chdir(workdir)
+    if not verbose:
+        sys.stdout = sys.stderr = open(os.devnull, "w")
+
+    start = time.perf_counter()
+    try:
+        transfer.main()
+    except BaseException:
+        results.put({"error": traceback.format_exc()})
+        return
+    results.put({"seconds": time.perf_counter() - start, "peak_rss": peak_rss_bytes()})
+
+
+def command_count(servers):
+    return sum(server.stats.round_trips for server in servers)
+
+
+def run_scenario(name, answers, servers, endpoints, workdir, messages, total_bytes, verbose):
+    """Run one mode of transfer.py in a separate process, so its memory use is measured on its own."""
+    commands_before = command_count(servers)
+    # A fresh interpreter rather than a fork, which would share the pages of the fake mailboxes
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_client, args=(answers, endpoints, workdir, verbose, results))
+    process.start()
+    result = results.get()
+    process.join()
+    if "error" in result:
+        raise RuntimeError(f"{name} failed:\n{result['error']}")
+
+    seconds = result["seconds"]
+    return {
+        "scenario": name,
+        "messages": messages,
+        "megabytes": round(total_bytes / (1024 * 1024), 2),
+        "seconds": round(seconds, 3),
+        "messages_per_second": round(messages / seconds, 1),
+        "mb_per_second": round(total_bytes / (1024 * 1024) / seconds, 2),
+        "round_trips_per_message": round((command_count(servers) - commands_before) / messages, 3),
+        "peak_rss_mb": round(result["peak_rss"] / (1024 * 1024), 1) if result["peak_rss"] else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of *results* against a baseline run, as readable lines."""
+    previous = {entry["scenario"]: entry for entry in baseline["results"]}
+    regressions = []
+    for entry in results:
+        before = previous.get(entry["scenario"])
+        if before is None:
+            continue
+        if entry["messages_per_second"] < before["messages_per_second"] * (1 - tolerance):
+            regressions.append(f"{entry['scenario']}: {entry['messages_per_second']} messages/s, was {before['messages_per_second']}")
+        if entry["round_trips_per_message"] > before["round_trips_per_message"] * (1 + tolerance) + 0.01:
+            regressions.append(f"{entry['scenario']}: {entry['round_trips_per_message']} round trips/message, was {before['round_trips_per_message']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transfer.py against local fake IMAP servers.")
+    parser.add_argument("--messages", type=int, default=1000, help="number of messages in the source account")
+    parser.add_argument("--mailboxes", type=int, default=3, help=f"number of folders to spread them over (max {len(MAILBOXES)})")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="mixed", help="mix of message shapes")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic mail")
+    parser.add_argument("--latency", type=float, default=0.0, help="delay added by the servers to every command, in seconds")
+    parser.add_argument("--bandwidth", type=float, default=0.0, help="cap on what each server connection sends, in MB/s")
+    parser.add_argument("--drop-after", type=int, help="drop the source connection after this many messages were fetched")
+    parser.add_argument("--throttle-every", type=int, help="answer every n-th APPEND with NO [THROTTLED]")
+    parser.add_argument("--workers", type=int, default=4, help="parallel connections for the transfer")
+    parser.add_argument("--no-compression", action="store_true", help="do not use COMPRESS=DEFLATE")
+    parser.add_argument("--scenarios", default="transfer,backup,restore", help="comma-separated scenarios to run")
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results saved in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline (fraction)")
+    parser.add_argument("--verbose", action="store_true", help="show the output of transfer.py")
+    args = parser.parse_args()
+
+    server_options = {"latency": args.latency, "bandwidth": args.bandwidth * 1024 * 1024 or None}
+    source = FakeIMAPServer(drop_fetch_after=args.drop_after, **server_options).start()
+    dest = FakeIMAPServer(throttle_every=args.throttle_every, **server_options).start()
+    endpoints = {SOURCE_HOST: (source.port, False), DEST_HOST: (dest.port, False)}
+
+    mailboxes = MAILBOXES[:max(1, min(args.mailboxes, len(MAILBOXES)))]
+    print(f"Generating {args.messages} messages ({args.profile}) in {len(mailboxes)} folders...")
+    total_bytes = populate(source.add_account(USERNAME, PASSWORD), args.messages, mailboxes, args.profile, args.seed)
+    dest_account = dest.add_account(USERNAME, PASSWORD)
+    for mailbox in mailboxes:
+        dest_account.mailbox(mailbox)
+    restore_account = dest.add_account(RESTORE_USERNAME, PASSWORD)
+    restore_account.mailbox("INBOX")
+
+    compression = "n" if args.no_compression else "y"
+    mailbox_numbers = ",".join(str(number) for number in range(1, len(mailboxes) + 1))
+    scenarios = {
+        "transfer": ["1", SOURCE_HOST, USERNAME, PASSWORD, DEST_HOST, USERNAME, PASSWORD, compression, "y", str(args.workers), "n"],
+        "backup": ["2", SOURCE_HOST, USERNAME, PASSWORD, compression, mailbox_numbers, BACKUP_PASSWORD, ""],
+        "restore": ["3", compression, "1", BACKUP_PASSWORD, mailbox_numbers, DEST_HOST, RESTORE_USERNAME, PASSWORD, "1"],
+    }
+    expected = {
+        "transfer": lambda: sum(len(dest_account.mailbox(mailbox).messages) for mailbox in mailboxes),
+        "backup": lambda: args.messages,
+        "restore": lambda: len(restore_account.mailbox("INBOX").messages),
+    }
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.scenarios.split(","):
+            name = name.strip()
+            if name not in scenarios:
+                parser.error(f"unknown scenario: {name}")
+            print(f"Running {name}...")
+            result = run_scenario(name, scenarios[name], [source, dest], endpoints, workdir, args.messages, total_bytes, args.verbose)
+            result["complete"] = expected[name]() == args.messages
+            results.append(result)
+
+    columns = ["scenario", "messages", "megabytes", "seconds", "messages_per_second", "mb_per_second",
+               "round_trips_per_message", "peak_rss_mb", "complete"]
+    widths = [max(len(column), 8) for column in columns]
+    print()
+    print("  ".join(column.ljust(width) if column == "scenario" else column.rjust(width)
+                    for column, width in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[column]).ljust(width) if column == "scenario" else str(result[column]).rjust(width)
+                        for column, width in zip(columns, widths)))
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("save", "baseline", "verbose")}
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({"settings": settings, "results": results}, file, indent=2)
+        print(f"\nResults saved to {args.save}")
+
+    failed = [f"{result['scenario']}: not all messages arrived" for result in results if not result["complete"]]
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get("settings") != settings:
+            print("\nWarning: the baseline was recorded with different settings.")
+        failed += compare(results, baseline, args.tolerance)
+    if failed:
+        print("\nRegressions:")
+        for line in failed:
+            print(f"  - {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
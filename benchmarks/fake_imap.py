@@ -0,0 +1,582 @@
+"""In-process IMAP server for benchmarking transfer.py without real mail accounts.
+
+It implements the subset of IMAP4rev1 (plus UIDPLUS, MOVE, CONDSTORE, LITERAL+, MULTIAPPEND and
+COMPRESS=DEFLATE) that transfer.py uses, keeps mailboxes in memory, counts every command and byte,
+and can add latency, limit bandwidth and inject failures.
+"""
+import re
+import socket
+import socketserver
+import threading
+import time
+import zlib
+
+
+class Mailbox:
+    """A folder: its messages (UID, body, flags, MODSEQ) and UID/MODSEQ counters."""
+
+    def __init__(self, name, uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = []  # dicts: uid, body, flags, modseq
+
+    def add(self, body, flags=()):
+        self.modseq += 1
+        msg = {'uid': self.uidnext, 'body': body, 'flags': list(flags), 'modseq': self.modseq}
+        self.uidnext += 1
+        self.messages.append(msg)
+        return msg
+
+
+class Account:
+    """A login and its folders."""
+
+    def __init__(self, username, password):
+        self.username = username
+        self.password = password
+        self.mailboxes = {}
+        self.lock = threading.RLock()
+
+    def mailbox(self, name):
+        if name not in self.mailboxes:
+            self.mailboxes[name] = Mailbox(name)
+        return self.mailboxes[name]
+
+
+class Stats:
+    """Commands, connections and bytes a server has seen."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+        self.connections = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def count(self, name):
+        with self.lock:
+            self.commands[name] = self.commands.get(name, 0) + 1
+
+    @property
+    def round_trips(self):
+        return sum(self.commands.values())
+
+
+DEFAULT_CAPABILITIES = ('IMAP4rev1', 'UIDPLUS', 'MOVE', 'CONDSTORE', 'ENABLE', 'LITERAL+', 'MULTIAPPEND',
+                        'COMPRESS=DEFLATE', 'UNSELECT')
+
+
+def parse_seqset(text, max_uid):
+    """Expand an IMAP sequence set such as '1:3,7,10:*' into a set of UIDs."""
+    result = set()
+    for part in text.split(','):
+        if ':' in part:
+            a, b = part.split(':')
+            a = max_uid if a == '*' else int(a)
+            b = max_uid if b == '*' else int(b)
+            if a > b:
+                a, b = b, a
+            result.update(range(a, b + 1))
+            if max_uid and (part.endswith('*') or part.startswith('*')):
+                result.add(max_uid)
+        else:
+            result.add(max_uid if part == '*' else int(part))
+    return result
+
+
+def tokenize(data):
+    """Tokenize an IMAP command; literals appear as bytes, lists as lists."""
+    tokens = []
+    stack = [tokens]
+    i = 0
+    n = len(data)
+    while i < n:
+        c = data[i]
+        if isinstance(c, bytes):
+            stack[-1].append(c)
+            i += 1
+            continue
+        if c == ' ':
+            i += 1
+        elif c == '(':
+            new = []
+            stack[-1].append(new)
+            stack.append(new)
+            i += 1
+        elif c == ')':
+            stack.pop()
+            i += 1
+        elif c == '"':
+            j = i + 1
+            out = []
+            while data[j] != '"':
+                if data[j] == '\\':
+                    j += 1
+                out.append(data[j])
+                j += 1
+            stack[-1].append(''.join(out))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < n and not isinstance(data[j], bytes):
+                ch = data[j]
+                if ch == '[':
+                    depth += 1
+                elif ch == ']':
+                    depth -= 1
+                elif depth == 0 and ch in ' ()':
+                    break
+                j += 1
+            stack[-1].append(''.join(data[i:j]))
+            i = j
+    return tokens
+
+
+class FakeIMAPServer:
+    """Threaded IMAP server on a free local port.
+    *latency* is added before every command (seconds), *bandwidth* caps what the server sends (bytes/s),
+    *drop_fetch_after* closes the connection after that many messages were sent in FETCH responses,
+    *drop_append_after* closes it when the APPEND after that many APPENDs arrives, *drop_copy_after* closes it
+    without answering the COPY or MOVE after that many (the messages are copied all the same), *throttle_every*
+    answers every n-th APPEND with NO [THROTTLED], and fetching a message whose body is in *corrupt* fails with BAD."""
+
+    def __init__(self, capabilities=DEFAULT_CAPABILITIES, latency=0.0, bandwidth=None,
+                 drop_fetch_after=None, drop_append_after=None, drop_copy_after=None, throttle_every=None, corrupt=()):
+        self.accounts = {}
+        self.corrupt = set(corrupt)
+        self.capabilities = list(capabilities)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.drop_fetch_after = drop_fetch_after
+        self.drop_append_after = drop_append_after
+        self.drop_copy_after = drop_copy_after
+        self.throttle_every = throttle_every
+        self.stats = Stats()
+        self.fetched_messages = 0
+        self.appends = 0
+        self.append_commands = 0
+        self.copy_commands = 0
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                Session(server, self.request).run()
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = TCPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add_account(self, username, password):
+        """Create an account and return it; add folders with account.mailbox(name)."""
+        self.accounts[username] = Account(username, password)
+        return self.accounts[username]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Session:
+    """One client connection: reads commands, runs them against the accounts and writes the responses."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = sock.makefile('rb')
+        self.account = None
+        self.selected = None
+        self.condstore = False
+        self.compress_out = None
+        self.decompress_in = None
+        self.inbuf = b''
+
+    # -- transport -------------------------------------------------------
+    def _recv_raw(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        with self.server.stats.lock:
+            self.server.stats.bytes_in += len(data)
+        if self.decompress_in is not None:
+            data = self.decompress_in.decompress(data)
+        return data
+
+    def readline(self):
+        while b'\r\n' not in self.inbuf:
+            self.inbuf += self._recv_raw()
+        line, self.inbuf = self.inbuf.split(b'\r\n', 1)
+        return line + b'\r\n'
+
+    def read(self, n):
+        while len(self.inbuf) < n:
+            self.inbuf += self._recv_raw()
+        data, self.inbuf = self.inbuf[:n], self.inbuf[n:]
+        return data
+
+    def write(self, data):
+        if self.compress_out is not None:
+            data = self.compress_out.compress(data) + self.compress_out.flush(zlib.Z_SYNC_FLUSH)
+        with self.server.stats.lock:
+            self.server.stats.bytes_out += len(data)
+        if self.server.bandwidth:
+            time.sleep(len(data) / float(self.server.bandwidth))
+        self.sock.sendall(data)
+
+    # -- command loop ----------------------------------------------------
+    def run(self):
+        with self.server.stats.lock:
+            self.server.stats.connections += 1
+        try:
+            self.write(b'* OK [CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'] fake ready\r\n')
+            while True:
+                parts = self.read_command()
+                if parts is None:
+                    return
+                if self.server.latency:
+                    time.sleep(self.server.latency)
+                tokens = tokenize(parts)
+                if len(tokens) < 2:
+                    self.write(b'* BAD\r\n')
+                    continue
+                tag, cmd, args = tokens[0], tokens[1].upper(), tokens[2:]
+                if cmd == 'UID':
+                    cmd = 'UID ' + args[0].upper()
+                    args = args[1:]
+                self.server.stats.count(cmd)
+                handler = getattr(self, 'cmd_' + cmd.replace(' ', '_'), None)
+                if handler is None:
+                    self.write(('%s BAD unknown command %s\r\n' % (tag, cmd)).encode())
+                    continue
+                try:
+                    result = handler(tag, args)
+                except EOFError:
+                    raise
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    self.write(('%s BAD %s\r\n' % (tag, e)).encode())
+                    continue
+                if result == 'LOGOUT':
+                    return
+        except (EOFError, ConnectionError, OSError):
+            pass
+        finally:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def read_command(self):
+        parts = []
+        while True:
+            try:
+                line = self.readline()
+            except EOFError:
+                return None
+            line = line[:-2]
+            m = re.search(br'\{(\d+)(\+?)\}$', line)
+            if not m:
+                parts.extend(line.decode('utf-8', 'surrogateescape'))
+                return parts
+            parts.extend(line[:m.start()].decode('utf-8', 'surrogateescape'))
+            if not m.group(2):
+                self.write(b'+ go ahead\r\n')
+            parts.append(self.read(int(m.group(1))))
+
+    # -- helpers ---------------------------------------------------------
+    def ok(self, tag, text='completed'):
+        self.write(('%s OK %s\r\n' % (tag, text)).encode())
+
+    def no(self, tag, text='failed'):
+        self.write(('%s NO %s\r\n' % (tag, text)).encode())
+
+    def _mailbox(self, name):
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        return self.account.mailboxes.get(name)
+
+    # -- commands --------------------------------------------------------
+    def cmd_CAPABILITY(self, tag, args):
+        self.write(b'* CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'\r\n')
+        self.ok(tag)
+
+    def cmd_NOOP(self, tag, args):
+        self.ok(tag)
+
+    def cmd_LOGOUT(self, tag, args):
+        self.write(b'* BYE\r\n')
+        self.ok(tag)
+        return 'LOGOUT'
+
+    def cmd_LOGIN(self, tag, args):
+        acct = self.server.accounts.get(args[0])
+        if acct is None or acct.password != args[1]:
+            self.no(tag, '[AUTHENTICATIONFAILED] invalid credentials')
+            return
+        self.account = acct
+        self.ok(tag, '[CAPABILITY ' + ' '.join(self.server.capabilities) + '] logged in')
+
+    def cmd_ENABLE(self, tag, args):
+        if any(a.upper() == 'CONDSTORE' for a in args):
+            self.condstore = True
+            self.write(b'* ENABLED CONDSTORE\r\n')
+        self.ok(tag)
+
+    def cmd_COMPRESS(self, tag, args):
+        self.ok(tag, 'DEFLATE active')
+        self.compress_out = zlib.compressobj(6, zlib.DEFLATED, -15)
+        self.decompress_in = zlib.decompressobj(-15)
+
+    def cmd_LIST(self, tag, args):
+        with self.account.lock:
+            for name in sorted(self.account.mailboxes):
+                self.write(('* LIST (\\HasNoChildren) "/" "%s"\r\n' % name).encode())
+        self.ok(tag)
+
+    def cmd_CREATE(self, tag, args):
+        with self.account.lock:
+            if self._mailbox(args[0]) is not None:
+                self.no(tag, '[ALREADYEXISTS] mailbox exists')
+                return
+            self.account.mailbox(args[0])
+        self.ok(tag)
+
+    def cmd_STATUS(self, tag, args):
+        box = self._mailbox(args[0])
+        if box is None:
+            self.no(tag, '[NONEXISTENT] no such mailbox')
+            return
+        self.write(('* STATUS "%s" (MESSAGES %d UIDNEXT %d UIDVALIDITY %d HIGHESTMODSEQ %d)\r\n'
+                    % (box.name, len(box.messages), box.uidnext, box.uidvalidity, box.modseq)).encode())
+        self.ok(tag)
+
+    def cmd_SELECT(self, tag, args):
+        box = self._mailbox(args[0])
+        if box is None:
+            self.no(tag, '[NONEXISTENT] no such mailbox')
+            return
+        self.selected = box
+        self.write(('* %d EXISTS\r\n* 0 RECENT\r\n' % len(box.messages)).encode())
+        self.write(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n')
+        self.write(('* OK [UIDVALIDITY %d] ok\r\n* OK [UIDNEXT %d] ok\r\n' % (box.uidvalidity, box.uidnext)).encode())
+        if self.condstore:
+            self.write(('* OK [HIGHESTMODSEQ %d] ok\r\n' % box.modseq).encode())
+        self.ok(tag, '[READ-WRITE] selected')
+
+    cmd_EXAMINE = cmd_SELECT
+
+    def cmd_CLOSE(self, tag, args):
+        self.selected = None
+        self.ok(tag)
+
+    cmd_UNSELECT = cmd_CLOSE
+
+    def _resolve(self, seqset):
+        box = self.selected
+        max_uid = box.messages[-1]['uid'] if box.messages else 0
+        wanted = parse_seqset(seqset, max_uid)
+        return [m for m in box.messages if m['uid'] in wanted]
+
+    def cmd_UID_SEARCH(self, tag, args):
+        box = self.selected
+        msgs = list(box.messages)
+        i = 0
+        while i < len(args):
+            a = args[i].upper() if isinstance(args[i], str) else args[i]
+            if a == 'ALL':
+                i += 1
+            elif a == 'UID':
+                wanted = parse_seqset(args[i + 1], box.uidnext - 1 if box.messages else 0)
+                msgs = [m for m in msgs if m['uid'] in wanted]
+                i += 2
+            elif a == 'HEADER':
+                field = args[i + 1].lower().encode()
+                value = args[i + 2]
+                value = value.encode() if isinstance(value, str) else value
+                out = []
+                for m in msgs:
+                    head = m['body'].split(b'\r\n\r\n', 1)[0]
+                    for line in head.split(b'\r\n'):
+                        if line.lower().startswith(field + b':') and value.lower() in line.lower():
+                            out.append(m)
+                            break
+                msgs = out
+                i += 3
+            elif a == 'CHARSET':
+                i += 2
+            else:
+                # bare sequence set
+                wanted = parse_seqset(args[i], box.uidnext)
+                msgs = [m for m in msgs if m['uid'] in wanted]
+                i += 1
+        self.write(('* SEARCH %s\r\n' % ' '.join(str(m['uid']) for m in msgs)).strip().encode() + b'\r\n')
+        self.ok(tag)
+
+    def cmd_UID_FETCH(self, tag, args):
+        box = self.selected
+        seqset = args[0]
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        items = [i.upper() if isinstance(i, str) else i for i in items]
+        # re-join nested list items like BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]
+        flat = []
+        for it in items:
+            if isinstance(it, list):
+                flat[-1] = flat[-1] + ' (' + ' '.join(it) + ')'
+            else:
+                flat.append(it)
+        changedsince = None
+        if len(args) > 2 and isinstance(args[2], list):
+            if args[2][0].upper() == 'CHANGEDSINCE':
+                changedsince = int(args[2][1])
+        if any(m['body'] in self.server.corrupt for m in self._resolve(seqset)) and any('BODY' in i for i in flat):
+            raise ValueError('corrupt message')
+        positions = {m['uid']: seq for seq, m in enumerate(box.messages, 1)}
+        for m in self._resolve(seqset):
+            if changedsince is not None and m['modseq'] <= changedsince:
+                continue
+            if self.server.drop_fetch_after is not None:
+                with self.server.stats.lock:
+                    self.server.fetched_messages += 1
+                    drop = self.server.fetched_messages == self.server.drop_fetch_after
+                if drop:
+                    self.sock.close()
+                    raise EOFError
+            seq = positions[m['uid']]
+            out = [('UID %d' % m['uid']).encode()]
+            for it in flat + (['MODSEQ'] if changedsince is not None else []):
+                if it == 'FLAGS':
+                    out.append(('FLAGS (%s)' % ' '.join(m['flags'])).encode())
+                elif it == 'RFC822.SIZE':
+                    out.append(('RFC822.SIZE %d' % len(m['body'])).encode())
+                elif it == 'UID':
+                    continue
+                elif it == 'MODSEQ':
+                    out.append(('MODSEQ (%d)' % m['modseq']).encode())
+                elif it.startswith('BODY.PEEK[') or it.startswith('BODY[') or it == 'RFC822':
+                    section = it[it.index('[') + 1:it.index(']')] if '[' in it else ''
+                    partial = re.search(r'<(\d+)\.(\d+)>$', it)
+                    if section.startswith('HEADER.FIELDS'):
+                        fields = [f.lower().encode() for f in section[section.index('(') + 1:-1].split()]
+                        head = m['body'].split(b'\r\n\r\n', 1)[0]
+                        lines = [l for l in head.split(b'\r\n') if l.split(b':', 1)[0].lower() in fields]
+                        data = b''.join(l + b'\r\n' for l in lines) + b'\r\n'
+                    elif section == 'HEADER':
+                        data = m['body'].split(b'\r\n\r\n', 1)[0] + b'\r\n\r\n'
+                    else:
+                        data = m['body']
+                    name = 'BODY[%s]' % section
+                    if partial:
+                        off, ln = int(partial.group(1)), int(partial.group(2))
+                        data = data[off:off + ln]
+                        name += '<%d>' % off
+                    out.append(name.encode() + (' {%d}\r\n' % len(data)).encode() + data)
+            self.write(('* %d FETCH (' % seq).encode() + b' '.join(out) + b')\r\n')
+        self.ok(tag)
+
+    def cmd_UID_STORE(self, tag, args):
+        seqset, mode, flags = args[0], args[1].upper(), args[2]
+        flags = flags if isinstance(flags, list) else [flags]
+        positions = {m['uid']: seq for seq, m in enumerate(self.selected.messages, 1)}
+        for m in self._resolve(seqset):
+            if mode.startswith('+'):
+                m['flags'] = sorted(set(m['flags']) | set(flags))
+            elif mode.startswith('-'):
+                m['flags'] = [f for f in m['flags'] if f not in flags]
+            else:
+                m['flags'] = list(flags)
+            self.selected.modseq += 1
+            m['modseq'] = self.selected.modseq
+            if not mode.endswith('.SILENT'):
+                self.write(('* %d FETCH (UID %d FLAGS (%s))\r\n'
+                            % (positions[m['uid']], m['uid'], ' '.join(m['flags']))).encode())
+        self.ok(tag)
+
+    def _copy(self, tag, args, move):
+        dest = self._mailbox(args[1])
+        if dest is None:
+            self.no(tag, '[TRYCREATE] no such mailbox')
+            return
+        src_uids, dst_uids = [], []
+        msgs = self._resolve(args[0])
+        for m in msgs:
+            new = dest.add(m['body'], m['flags'])
+            src_uids.append(str(m['uid']))
+            dst_uids.append(str(new['uid']))
+        if move:
+            moved = {m['uid'] for m in msgs}
+            self.selected.messages[:] = [m for m in self.selected.messages if m['uid'] not in moved]
+        if self.server.drop_copy_after is not None:
+            with self.server.stats.lock:
+                self.server.copy_commands += 1
+                drop = self.server.copy_commands == self.server.drop_copy_after + 1
+            if drop:
+                self.sock.close()
+                raise EOFError
+        self.ok(tag, '[COPYUID %d %s %s] done' % (dest.uidvalidity, ','.join(src_uids), ','.join(dst_uids)))
+
+    def cmd_UID_COPY(self, tag, args):
+        self._copy(tag, args, False)
+
+    def cmd_UID_MOVE(self, tag, args):
+        self._copy(tag, args, True)
+
+    def _expunge(self, tag, uids=None):
+        box = self.selected
+        for seq in range(len(box.messages), 0, -1):
+            m = box.messages[seq - 1]
+            if '\\Deleted' in m['flags'] and (uids is None or m['uid'] in uids):
+                del box.messages[seq - 1]
+                self.write(('* %d EXPUNGE\r\n' % seq).encode())
+        self.ok(tag)
+
+    def cmd_EXPUNGE(self, tag, args):
+        self._expunge(tag)
+
+    def cmd_UID_EXPUNGE(self, tag, args):
+        self._expunge(tag, {m['uid'] for m in self._resolve(args[0])})
+
+    def cmd_APPEND(self, tag, args):
+        box = self._mailbox(args[0])
+        if box is None:
+            self.no(tag, '[TRYCREATE] no such mailbox')
+            return
+        if self.server.drop_append_after is not None:
+            with self.server.stats.lock:
+                self.server.append_commands += 1
+                drop = self.server.append_commands == self.server.drop_append_after + 1
+            if drop:
+                self.sock.close()
+                raise EOFError
+        if self.server.throttle_every:
+            with self.server.stats.lock:
+                self.server.appends += 1
+                throttle = self.server.appends % self.server.throttle_every == 0
+            if throttle:
+                self.no(tag, '[THROTTLED] slow down')
+                return
+        rest = args[1:]
+        uids = []
+        while rest:
+            flags = []
+            if isinstance(rest[0], list):
+                flags = rest[0]
+                rest = rest[1:]
+            if rest and isinstance(rest[0], str):
+                rest = rest[1:]  # internal date
+            body = rest[0]
+            rest = rest[1:]
+            uids.append(str(box.add(body, flags)['uid']))
+        self.ok(tag, '[APPENDUID %d %s] appended' % (box.uidvalidity, ','.join(uids)))
+
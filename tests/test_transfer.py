@@ -0,0 +1,484 @@
+"""End-to-end tests of transfer.py against the fake IMAP server in benchmarks/.
+
+Every test starts its own servers on free local ports and works in a temporary directory, so the
+journal, backups and metrics files of one test never leak into another. Run them with:
+
+    python -m pytest tests
+"""
+import builtins
+import json
+import os
+import socket
+import sys
+import time
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, "benchmarks")]
+
+import transfer
+from fake_imap import DEFAULT_CAPABILITIES, FakeIMAPServer
+
+# Source and destination are told apart by host name; both resolve to this machine
+SOURCE_HOST = "127.0.0.1"
+DEST_HOST = "localhost"
+PASSWORD = "secret"
+BACKUP_PASSWORD = "backup-secret"
+
+
+def make_message(index, size=300):
+    """Raw bytes of a small message with a unique Message-ID."""
+    header = (f"From: sender@example.com\r\nTo: user@example.com\r\nSubject: Message {index}\r\n"
+              f"Message-ID: <m{index}@example.com>\r\n\r\n").encode()
+    return header + (f"Line {index} of the body.\r\n" * (size // 24 + 1)).encode()
+
+
+def message_ids(mailbox):
+    return sorted(transfer.extract_message_id(message["body"]) for message in mailbox.messages)
+
+
+def flags_by_id(mailbox):
+    return {transfer.extract_message_id(message["body"]): sorted(message["flags"]) for message in mailbox.messages}
+
+
+def fill(mailbox, indexes, size=300):
+    for index in indexes:
+        mailbox.add(make_message(index, size), [r"\Seen"] if index % 2 else [])
+
+
+def set_flags(mailbox, message, flags):
+    """Change a message's flags the way a mail client would, bumping its MODSEQ."""
+    mailbox.modseq += 1
+    message["flags"] = list(flags)
+    message["modseq"] = mailbox.modseq
+
+
+def account(server, host, username="user"):
+    return {"host": host, "username": username, "password": PASSWORD, "port": server.port, "ssl": False}
+
+
+@pytest.fixture
+def start_server():
+    """Start fake IMAP servers with the given options; they are stopped after the test."""
+    servers = []
+
+    def start(**options):
+        server = FakeIMAPServer(**options).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture(autouse=True)
+def isolated_run(tmp_path, monkeypatch):
+    """Run every test in its own directory with fresh engine state and short rate limit pauses."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(transfer, "THROTTLE_BASE_DELAY", 0.01)
+    transfer.host_health.clear()
+    transfer.connection_endpoints.clear()
+    transfer.metrics.reset("transfer")
+    yield
+    transfer.close_pools()
+
+
+def run_main(monkeypatch, answers):
+    """Run the interactive main() with scripted answers to its prompts."""
+    answers = iter(answers)
+    monkeypatch.setattr(builtins, "input", lambda prompt="": next(answers))
+    monkeypatch.setattr(transfer, "getpass", lambda prompt="": next(answers))
+    transfer.main()
+
+
+class FolderList:
+    """Stand-in for an IMAPClient that only lists folders."""
+
+    def __init__(self, names):
+        self.names = names
+
+    def list_folders(self):
+        return [((), "/", name) for name in self.names]
+
+
+def test_transfer_copies_messages_and_flags_and_skips_duplicates(start_server):
+    source, dest = start_server(), start_server()
+    source_account = source.add_account("user", PASSWORD)
+    fill(source_account.mailbox("INBOX"), range(30))
+    fill(source_account.mailbox("Sent"), range(100, 110))
+    dest_account = dest.add_account("user", PASSWORD)
+    fill(dest_account.mailbox("INBOX"), range(5))
+    dest_account.mailbox("Sent Items")
+
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=2)
+
+    inbox = dest_account.mailbox("INBOX")
+    assert message_ids(inbox) == message_ids(source_account.mailbox("INBOX"))
+    assert sorted(message["body"] for message in inbox.messages) == sorted(message["body"] for message in source_account.mailbox("INBOX").messages)
+    assert flags_by_id(inbox) == {**flags_by_id(source_account.mailbox("INBOX")), **flags_by_id(dest_account.mailbox("INBOX"))}
+    assert message_ids(dest_account.mailbox("Sent Items")) == message_ids(source_account.mailbox("Sent"))
+    stats = {folder["src_box"]: folder for folder in folders}
+    assert (stats["INBOX"]["transferred"], stats["INBOX"]["duplicates"]) == (25, 5)
+    assert stats["Sent"]["dest_box"] == "Sent Items"
+
+
+@pytest.mark.parametrize("same_account", [False, True], ids=["two-servers", "server-side"])
+def test_folders_copied_into_one_destination_folder_share_its_index(start_server, same_account):
+    source = start_server()
+    dest = source if same_account else start_server()
+    source_account = source.add_account("user", PASSWORD)
+    fill(source_account.mailbox("INBOX.Sent"), range(10))
+    fill(source_account.mailbox("Sent"), range(10))
+    fill(source_account.mailbox("Sent"), [10])
+    dest_account = source_account if same_account else dest.add_account("user", PASSWORD)
+    dest_account.mailbox("Archive")
+
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, SOURCE_HOST if same_account else DEST_HOST),
+                                       mapping={"INBOX.Sent": "Archive", "Sent": "Archive"}, auto=False, workers=2)
+
+    assert message_ids(dest_account.mailbox("Archive")) == message_ids(source_account.mailbox("Sent"))
+    assert sum(folder["transferred"] for folder in folders) == 11
+    assert sum(folder["duplicates"] for folder in folders) == 10
+
+
+def test_transfer_resumes_from_the_journal(start_server):
+    source, dest = start_server(), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(20))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=2)
+
+    # A second run only fetches what the journal does not list as copied
+    fill(source_inbox, range(20, 23))
+    transfer.metrics.reset("transfer")
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=2)
+
+    assert (folders[0]["resumed"], folders[0]["transferred"], folders[0]["duplicates"]) == (20, 3, 0)
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+    assert transfer.metrics.report()["counters"]["messages_fetched"] == 3
+
+
+def test_transfer_survives_a_dropped_source_connection(start_server):
+    source, dest = start_server(drop_fetch_after=15), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(40))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=1)
+
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+
+
+def test_migrate_account_refuses_to_run_concurrently(start_server):
+    source, dest = start_server(), start_server()
+    fill(source.add_account("user", PASSWORD).mailbox("INBOX"), range(3))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+
+    # As if another thread were in the middle of a migration
+    with transfer.migration_lock:
+        with pytest.raises(RuntimeError):
+            transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST))
+    assert not dest_inbox.messages
+
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST))
+    assert len(dest_inbox.messages) == 3
+
+
+def test_incremental_sync_copies_new_messages_and_flag_changes(start_server):
+    source, dest = start_server(), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(10))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    fill(source_inbox, [10])
+    set_flags(source_inbox, source_inbox.messages[3], [r"\Flagged"])
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    assert (folders[0]["total"], folders[0]["transferred"], folders[0]["flag_updates"]) == (1, 1, 1)
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+    assert flags_by_id(dest_inbox)["<m3@example.com>"] == [r"\Flagged"]
+
+    # Nothing changed: the folder costs a STATUS and no search or fetch
+    source.stats.commands.clear()
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+    assert "UID SEARCH" not in source.stats.commands and "UID FETCH" not in source.stats.commands
+
+
+def test_incremental_sync_indexes_only_new_destination_messages(start_server, monkeypatch):
+    source, dest = start_server(), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(10))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(dest_inbox, range(100, 150))
+    # Messages that arrive while a run copies are indexed by the next one, so it starts at the UIDNEXT seen before
+    dest_uidnext = dest_inbox.uidnext
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    # A new message, one that also reached the destination since, and a copy of an already copied one
+    fill(source_inbox, [10, 11])
+    fill(dest_inbox, [11])
+    source_inbox.add(make_message(5))
+    first_uids = []
+    load_message_id_index = transfer.load_message_id_index
+
+    def spy(client, host, username, password, current_folder, first_uid=1, last_uid=None):
+        first_uids.append(first_uid)
+        return load_message_id_index(client, host, username, password, current_folder, first_uid, last_uid)
+
+    monkeypatch.setattr(transfer, "load_message_id_index", spy)
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    assert first_uids == [dest_uidnext]
+    assert (folders[0]["transferred"], folders[0]["duplicates"]) == (1, 2)
+    assert len(dest_inbox.messages) == 50 + 12
+
+
+def test_incremental_sync_finds_flag_targets_by_message_id(start_server):
+    source = start_server()
+    dest = start_server(capabilities=[capability for capability in DEFAULT_CAPABILITIES if capability != "UIDPLUS"])
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(5))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(dest_inbox, [2])
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    # Neither the appended messages nor the duplicate have a destination UID in the journal
+    set_flags(source_inbox, source_inbox.messages[1], [r"\Flagged"])
+    set_flags(source_inbox, source_inbox.messages[2], [r"\Answered"])
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), incremental=True)
+
+    assert folders[0]["flag_updates"] == 2
+    assert flags_by_id(dest_inbox)["<m1@example.com>"] == [r"\Flagged"]
+    assert flags_by_id(dest_inbox)["<m2@example.com>"] == [r"\Answered"]
+
+
+def test_incremental_sync_retries_messages_that_could_not_be_fetched(start_server):
+    source, dest = start_server(), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(5))
+    source.corrupt.add(source_inbox.messages[2]["body"])
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+
+    folders = transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=1, incremental=True)
+    assert len(dest_inbox.messages) == 4
+    assert folders[0]["skipped"] == [source_inbox.messages[2]["uid"]]
+
+    source.corrupt.clear()
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=1, incremental=True)
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+
+
+@pytest.mark.parametrize("drop_append_after", [None, 2])
+@pytest.mark.parametrize("missing", [(), ("MULTIAPPEND",), ("MULTIAPPEND", "LITERAL+")],
+                         ids=["multiappend", "pipelined", "single"])
+def test_append_paths_store_every_message_once(start_server, missing, drop_append_after):
+    source = start_server()
+    dest = start_server(capabilities=[capability for capability in DEFAULT_CAPABILITIES if capability not in missing],
+                        drop_append_after=drop_append_after)
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(12))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=1)
+
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+    assert flags_by_id(dest_inbox) == flags_by_id(source_inbox)
+
+
+def test_append_batch_keeps_confirmed_messages_when_the_connection_breaks(start_server):
+    dest = start_server(capabilities=[capability for capability in DEFAULT_CAPABILITIES if capability != "MULTIAPPEND"],
+                        drop_append_after=2)
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    transfer.connection_endpoints[DEST_HOST] = (dest.port, False)
+    client = transfer.connect_imap(DEST_HOST, "user", PASSWORD)
+    client.select_folder("INBOX")
+
+    messages = [(make_message(index), []) for index in range(5)]
+    results, client = transfer.safe_append_batch(client, DEST_HOST, "user", PASSWORD, "INBOX", "INBOX", messages)
+    client.logout()
+
+    assert message_ids(dest_inbox) == sorted(f"<m{index}@example.com>" for index in range(5))
+    assert results == [message["uid"] for message in sorted(dest_inbox.messages, key=lambda message: message["body"])]
+
+
+@pytest.mark.parametrize("literal_plus", [True, False], ids=["literal-plus", "synchronising"])
+def test_large_messages_are_spooled_and_streamed(start_server, monkeypatch, literal_plus):
+    monkeypatch.setattr(transfer, "LARGE_MESSAGE_BYTES", 100_000)
+    source = start_server()
+    dest = start_server(capabilities=[capability for capability in DEFAULT_CAPABILITIES if literal_plus or capability != "LITERAL+"])
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(10))
+    # Larger than a spool part, so they are fetched in several pieces
+    fill(source_inbox, [100, 101], size=transfer.SPOOL_PART_BYTES + 500_000)
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=2)
+
+    assert sorted(message["body"] for message in dest_inbox.messages) == sorted(message["body"] for message in source_inbox.messages)
+    assert flags_by_id(dest_inbox) == flags_by_id(source_inbox)
+    assert transfer.metrics.report()["counters"]["messages_spooled"] == 2
+
+
+@pytest.mark.parametrize("move", [False, True], ids=["copy", "move"])
+def test_same_account_is_copied_on_the_server(start_server, move):
+    server = start_server()
+    user = server.add_account("user", PASSWORD)
+    fill(user.mailbox("INBOX"), range(15))
+    sources = message_ids(user.mailbox("INBOX"))
+    fill(user.mailbox("Archive"), [3])
+
+    folders = transfer.migrate_account(account(server, SOURCE_HOST), account(server, SOURCE_HOST), mapping={"INBOX": "Archive"},
+                                       auto=False, move=move)
+
+    assert message_ids(user.mailbox("Archive")) == sources
+    assert (folders[0]["transferred"], folders[0]["duplicates"]) == (14, 1)
+    assert server.stats.commands.get("UID MOVE" if move else "UID COPY") and "APPEND" not in server.stats.commands
+    # Moving also removes the message the destination already had
+    assert len(user.mailbox("INBOX").messages) == (0 if move else 15)
+
+
+@pytest.mark.parametrize("move", [False, True], ids=["copy", "move"])
+def test_server_side_copy_is_retried_without_copying_twice(start_server, monkeypatch, move):
+    server = start_server(drop_copy_after=1)
+    user = server.add_account("user", PASSWORD)
+    fill(user.mailbox("INBOX"), range(15))
+    sources = message_ids(user.mailbox("INBOX"))
+    monkeypatch.setattr(transfer, "SERVER_COPY_MESSAGES", 5)
+
+    folders = transfer.migrate_account(account(server, SOURCE_HOST), account(server, SOURCE_HOST), mapping={"INBOX": "Archive"},
+                                       auto=False, move=move)
+
+    assert message_ids(user.mailbox("Archive")) == sources
+    assert folders[0]["transferred"] == 15
+    assert len(user.mailbox("INBOX").messages) == (0 if move else 15)
+
+
+def test_move_leaves_duplicates_without_uidplus(start_server):
+    server = start_server(capabilities=[capability for capability in DEFAULT_CAPABILITIES if capability != "UIDPLUS"])
+    user = server.add_account("user", PASSWORD)
+    fill(user.mailbox("INBOX"), range(5))
+    fill(user.mailbox("Archive"), [3])
+
+    transfer.migrate_account(account(server, SOURCE_HOST), account(server, SOURCE_HOST), mapping={"INBOX": "Archive"},
+                             auto=False, move=True)
+
+    assert message_ids(user.mailbox("INBOX")) == ["<m3@example.com>"]
+    assert "EXPUNGE" not in server.stats.commands and "UID EXPUNGE" not in server.stats.commands
+
+
+def test_replaced_control_connections_are_closed_and_returned_to_the_pool(start_server, monkeypatch):
+    source, dest = start_server(), start_server()
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(5))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    for name, value in (("source_host", SOURCE_HOST), ("source_username", "user"), ("source_password", PASSWORD),
+                        ("dest_host", DEST_HOST), ("dest_username", "user"), ("dest_password", PASSWORD)):
+        monkeypatch.setattr(transfer, name, value)
+    transfer.connection_endpoints[SOURCE_HOST] = (source.port, False)
+    transfer.connection_endpoints[DEST_HOST] = (dest.port, False)
+    replacements = []
+    ensure_connection = transfer.ensure_connection
+
+    def spy(client, *args):
+        new_client = ensure_connection(client, *args)
+        if new_client is not client:
+            replacements.append(new_client)
+        return new_client
+
+    monkeypatch.setattr(transfer, "ensure_connection", spy)
+    source_client = transfer.connect_imap(SOURCE_HOST, "user", PASSWORD)
+    dest_client = transfer.connect_imap(DEST_HOST, "user", PASSWORD)
+    # The source control connection dies before the folder is selected
+    source_client._imap.sock.shutdown(socket.SHUT_RDWR)
+    source_client.last_activity = 0
+
+    transfer.transfer_folders(source_client, dest_client, [("INBOX", "INBOX")], workers=1)
+    dest_client.logout()
+
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+    assert source_client._imap.sock.fileno() == -1
+    idle = [client for pool in transfer.connection_pools.values() for client, _ in pool.idle]
+    assert len(replacements) == 1 and replacements[0] in idle
+
+
+def test_backup_incremental_backup_and_chain_restore(start_server, monkeypatch):
+    server = start_server()
+    inbox = server.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(inbox, range(10))
+    restored = server.add_account("restore", PASSWORD).mailbox("INBOX")
+    transfer.connection_endpoints[SOURCE_HOST] = (server.port, False)
+
+    run_main(monkeypatch, ["2", SOURCE_HOST, "user", PASSWORD, "y", "1", BACKUP_PASSWORD, ""])
+    first = sorted(name for name in os.listdir() if name.endswith(".zip"))
+    assert len(first) == 1
+
+    # The next backup builds on the first one; backups are named by the second they are made in
+    fill(inbox, range(10, 14))
+    time.sleep(1.1)
+    run_main(monkeypatch, ["2", SOURCE_HOST, "user", PASSWORD, "y", "1", "1", BACKUP_PASSWORD, ""])
+    backups = sorted(name for name in os.listdir() if name.endswith(".zip"))
+    assert len(backups) == 2 and backups[0] == first[0]
+    assert transfer.metrics.report()["counters"]["messages_backed_up"] == 4
+
+    with transfer.BackupChain(backups[1], BACKUP_PASSWORD.encode()) as chain:
+        manifest = json.loads(chain.archives[0][1].read(transfer.BACKUP_MANIFEST))
+        assert manifest["parent"] == backups[0]
+        assert len(manifest["mailboxes"]["INBOX"]["messages"]) == 4
+        assert len(chain.mailboxes()["INBOX"]) == 14
+
+    # Restoring the newest backup reads through the whole chain
+    run_main(monkeypatch, ["3", "y", "2", BACKUP_PASSWORD, "1", SOURCE_HOST, "restore", PASSWORD, "1"])
+    assert sorted(message["body"] for message in restored.messages) == sorted(message["body"] for message in inbox.messages)
+
+
+def test_match_mailboxes_keeps_the_interactive_matching():
+    source = FolderList(["INBOX", "Sent", "Junk", "INBOX.Sent", "Trash", "Projects"])
+    dest = FolderList(["inbox", "Sent Items", "Sent", "Spam", "Deleted"])
+
+    # Only the source folder's own aliases count, in the order the destination lists its folders
+    assert transfer.match_mailboxes(source, dest) == [("INBOX", "inbox"), ("Sent", "Sent Items"), ("Trash", "Deleted")]
+
+
+def test_match_mailboxes_with_alias_groups_prefers_the_same_name():
+    source = FolderList(["INBOX", "INBOX.Sent", "Sent Items", "Trash", "Projects"])
+    dest = FolderList(["Sent", "INBOX.Sent", "Sent Items", "inbox", "Deleted"])
+
+    assert transfer.match_mailboxes(source, dest, alias_groups=True) == [("INBOX", "inbox"), ("INBOX.Sent", "INBOX.Sent"),
+                                                                         ("Sent Items", "Sent Items"), ("Trash", "Deleted")]
+
+
+def test_match_mailboxes_with_alias_groups_falls_back_to_aliases_and_honours_mapping_and_exclude():
+    source = FolderList(["INBOX", "Sent Items", "Junk", "Old Projects"])
+    dest = FolderList(["INBOX", "Sent", "Spam"])
+
+    assert transfer.match_mailboxes(source, dest, alias_groups=True) == [("INBOX", "INBOX"), ("Sent Items", "Sent"), ("Junk", "Spam")]
+    assert transfer.match_mailboxes(source, dest, mapping={"Old Projects": "Archive/Projects"}, exclude=["Junk"], alias_groups=True) == [
+        ("INBOX", "INBOX"), ("Sent Items", "Sent"), ("Old Projects", "Archive/Projects")]
+    assert transfer.match_mailboxes(source, dest, mapping={"old projects": "Archive"}, auto=False) == [("Old Projects", "Archive")]
+    assert transfer.match_mailboxes(FolderList(["Work"]), dest, aliases={"work": ["spam"]}) == [("Work", "Spam")]
+
+
+def test_rate_limits_do_not_open_the_circuit_breaker(start_server):
+    for _ in range(transfer.CIRCUIT_BREAKER_FAILURES * 3):
+        transfer.record_host_result("throttled.example.com", transfer.IMAPClientError("NO [THROTTLED] slow down"))
+    with pytest.raises(ConnectionError):
+        for _ in range(transfer.CIRCUIT_BREAKER_FAILURES):
+            transfer.record_host_result("broken.example.com", OSError("connection reset"))
+
+    source, dest = start_server(), start_server(throttle_every=3)
+    source_inbox = source.add_account("user", PASSWORD).mailbox("INBOX")
+    fill(source_inbox, range(20))
+    dest_inbox = dest.add_account("user", PASSWORD).mailbox("INBOX")
+    transfer.migrate_account(account(source, SOURCE_HOST), account(dest, DEST_HOST), workers=2)
+    assert message_ids(dest_inbox) == message_ids(source_inbox)
+
+
+def test_archive_compression_stores_only_binary_compressed_attachments():
+    assert transfer.archive_compression(6) == transfer.zipfile.ZIP_DEFLATED
+    assert transfer.archive_compression(0) == transfer.zipfile.ZIP_STORED
+    assert transfer.archive_compression(6, {"filename": "photo.JPG", "encoding": "binary", "segment": 1}) == transfer.zipfile.ZIP_STORED
+    assert transfer.archive_compression(6, {"filename": "photo.jpg", "encoding": "base64", "segment": 1}) == transfer.zipfile.ZIP_DEFLATED
+    assert transfer.archive_compression(6, {"filename": "notes.txt", "encoding": "8bit", "segment": 1}) == transfer.zipfile.ZIP_DEFLATED
@@ -1,13 +1,111 @@
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import random
+import re
+import socket
+import sqlite3
+import ssl
+import sys
+import tempfile
+import traceback
 import zipfile
 import pyzipper
 from getpass import getpass
 from imapclient import IMAPClient
+from imapclient.exceptions import IMAPClientAbortError, IMAPClientError, LoginError
+from imapclient.imapclient import seq_to_parenstr
 from email import message_from_bytes
 from tqdm import tqdm
-import shutil
+import threading
 import time
-
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+
+# Upper bounds for one batched FETCH of full message bodies
+FETCH_CHUNK_BYTES = 20 * 1024 * 1024
+FETCH_CHUNK_MESSAGES = 500
+
+# Parallel transfer settings: worker connections per server, the most connections
+# we open to a single server, and the largest UID range handed to one worker at a time
+TRANSFER_WORKERS = 4
+MAX_CONNECTIONS_PER_HOST = 10
+WORK_UNIT_MESSAGES = 1000
+
+# Messages of at least LARGE_MESSAGE_BYTES (by RFC822.SIZE) are copied in a lane of their own, after the
+# small ones: they are downloaded into a temporary file in parts of SPOOL_PART_BYTES and streamed from there
+# into APPEND, so a worker never holds more than one part of such a message in memory
+LARGE_MESSAGE_BYTES = 10 * 1024 * 1024
+SPOOL_PART_BYTES = 4 * 1024 * 1024
+
+# Limits for the messages buffered between a worker's fetch and append stages
+PIPELINE_QUEUE_MESSAGES = 200
+PIPELINE_QUEUE_BYTES = 64 * 1024 * 1024
+
+# Retry policy shared by all IMAP operations: attempts per operation, bounds of the exponential backoff
+# in seconds (with jitter), how long a connection may sit idle before it is checked with NOOP, the first
+# pause after a server rate limit, and how many failures in a row (rate limits aside) make us give up on a server
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 60
+LIVENESS_IDLE_SECONDS = 60
+THROTTLE_BASE_DELAY = 10
+CIRCUIT_BREAKER_FAILURES = 20
+
+# Server responses that mean "slow down" (e.g. Gmail's [THROTTLED]) and other temporary refusals worth retrying
+THROTTLE_RESPONSES = ("[THROTTLED]", "[LIMIT]", "TOO MANY", "RATE LIMIT")
+TRANSIENT_RESPONSES = THROTTLE_RESPONSES + ("[UNAVAILABLE]", "[INUSE]", "TRY AGAIN")
+
+# Upper bounds for one batched upload (MULTIAPPEND or pipelined APPENDs) to the destination, and the largest
+# literal LITERAL- allows to be sent without waiting for the server (RFC 7888)
+APPEND_BATCH_MESSAGES = 50
+APPEND_BATCH_BYTES = 8 * 1024 * 1024
+LITERAL_MINUS_MAX_BYTES = 4096
+
+# Compression level for what we send over connections using COMPRESS=DEFLATE (RFC 4978)
+WIRE_COMPRESSION_LEVEL = 6
+
+# Largest UID set sent in one server-side UID COPY/MOVE when both folders are in the same account
+SERVER_COPY_MESSAGES = 1000
+
+# Journal of completed messages, used to resume an interrupted transfer
+TRANSFER_JOURNAL = "transfer_journal.db"
+
+# Up to this many messages are looked up in a destination folder with one HEADER SEARCH each;
+# for more, the Message-IDs of the whole folder are fetched in bulk instead
+MESSAGE_ID_SEARCH_MAX = 50
+
+# Metrics of each run, written as a JSON report and as a Prometheus textfile (for node_exporter's
+# textfile collector), and the upper bounds in seconds of the IMAP command latency histogram buckets
+METRICS_REPORT = "transfer_metrics.json"
+METRICS_TEXTFILE = "transfer_metrics.prom"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Batch migrations (--jobs): connections all running jobs may hold together, and the folder that
+# gets each job's journal, metrics and log
+BATCH_MAX_CONNECTIONS = 40
+BATCH_STATE_DIR = "migration_state"
+
+# Backup archive settings: default compression level (0 stores entries uncompressed), threads that
+# compress and encrypt entries, how much encoded data may wait to be written, and attachment types
+# that are already compressed and are stored as they are
+BACKUP_COMPRESSION_LEVEL = 6
+BACKUP_WORKERS = os.cpu_count() or 2
+BACKUP_PENDING_BYTES = 64 * 1024 * 1024
+# Content-addressed backup layout: every message is stored as a list of segments under objects/<sha256>,
+# with MIME parts of at least PART_OBJECT_MIN_BYTES (and every attachment) in a segment of their own
+BACKUP_FORMAT = 2
+BACKUP_MANIFEST = "manifest.json"
+PART_OBJECT_MIN_BYTES = 4096
+PRECOMPRESSED_EXTENSIONS = {".zip", ".gz", ".tgz", ".bz2", ".xz", ".7z", ".rar", ".jpg", ".jpeg", ".png", ".gif",
+                            ".webp", ".heic", ".mp3", ".mp4", ".m4a", ".mov", ".avi", ".mkv", ".docx", ".xlsx",
+                            ".pptx", ".odt", ".ods", ".odp", ".pdf"}
 
 
 def choose_mailbox(client, prompt):
@@ -22,8 +120,13 @@ def choose_mailbox(client, prompt):
             return mailboxes[int(choice) - 1]
         print("Invalid choice, please try again.")
 
-def match_mailboxes(source_client, dest_client):
-    """Match source and destination mailboxes based on their names or aliases."""
+def match_mailboxes(source_client, dest_client, mapping=None, aliases=None, exclude=(), auto=True, alias_groups=False):
+    """Match source and destination mailboxes based on their names or aliases.
+    *mapping* sends source mailboxes to a destination of choice (which may not exist yet), *aliases* adds
+    names to the alias lists, and mailboxes in *exclude* are left out. With *auto* off only mapped mailboxes are matched.
+    By default a source mailbox goes to the first destination mailbox of the same name or listed among its
+    aliases. With *alias_groups* (batch jobs) a destination of the same name wins, and otherwise any two
+    names of one alias group match, so "Junk" also goes to "Spam" and "INBOX.Sent" to "Sent"."""
     source_mailboxes = [box[-1] for box in source_client.list_folders()]
     dest_mailboxes = [box[-1] for box in dest_client.list_folders()]
 
@@ -36,13 +139,37 @@ def match_mailboxes(source_client, dest_client):
         "drafts": ["drafts", "inbox.drafts"],
         # Add more aliases as needed
     }
+    for name, names in (aliases or {}).items():
+        mailbox_aliases.setdefault(name.lower(), [name.lower()]).extend(names)
+    mapping = {src_box.lower(): dest_box for src_box, dest_box in (mapping or {}).items()}
+    exclude = {src_box.lower() for src_box in exclude}
+
+    for src_box in mapping:
+        if src_box not in [box.lower() for box in source_mailboxes]:
+            print(f"Warning: mapped mailbox {src_box} does not exist in the source account.")
 
     matches = []
     for src_box in source_mailboxes:
-        for dest_box in dest_mailboxes:
-            if src_box.lower() == dest_box.lower() or dest_box.lower() in [alias.lower() for alias in mailbox_aliases.get(src_box.lower(), [])]:
-                matches.append((src_box, dest_box))
-                break
+        if src_box.lower() in exclude:
+            continue
+        if src_box.lower() in mapping:
+            matches.append((src_box, mapping[src_box.lower()]))
+            continue
+        if not auto:
+            continue
+        if alias_groups:
+            # A destination folder of the same name wins; otherwise any two names of the same alias group
+            # match, e.g. "Sent Items" and "INBOX.Sent"
+            dest_box = next((dest_box for dest_box in dest_mailboxes if dest_box.lower() == src_box.lower()), None)
+            if dest_box is None:
+                names = next(({name} | {alias.lower() for alias in group} for name, group in mailbox_aliases.items()
+                              if src_box.lower() == name or src_box.lower() in [alias.lower() for alias in group]), set())
+                dest_box = next((dest_box for dest_box in dest_mailboxes if dest_box.lower() in names), None)
+        else:
+            dest_box = next((dest_box for dest_box in dest_mailboxes if src_box.lower() == dest_box.lower() or
+                             dest_box.lower() in [alias.lower() for alias in mailbox_aliases.get(src_box.lower(), [])]), None)
+        if dest_box is not None:
+            matches.append((src_box, dest_box))
     return matches
 
 def filter_flags_for_append(flags):
@@ -64,481 +191,2383 @@ def filter_flags_for_append(flags):
     
     return filtered_flags
 
-# Backup option
-backup_option = input("Choose an option:\n1. Transfer emails\n2. Backup emails\n3. Restore emails\nEnter your choice: ")
-while backup_option not in ['1', '2', '3']:
-    print("Invalid choice, please try again.")
-    backup_option = input("Choose an option:\n1. Transfer emails\n2. Backup emails\n3. Restore emails\nEnter your choice: ")
+# Accounts the transfer engine works on; main() fills them in from the prompts
+source_host = source_username = source_password = None
+dest_host = dest_username = dest_password = None
+
+# Whether connections negotiate COMPRESS=DEFLATE with servers that support it
+wire_compression = True
+
+# Port and TLS mode that worked for each host, and the TLS context per host (which keeps its last session)
+connection_endpoints = {}
+tls_contexts = {}
+connection_lock = threading.Lock()
+
+# The engine keeps the accounts of the running migration in the globals above, so only one
+# migrate_account call may run at a time in a process
+migration_lock = threading.Lock()
+
+# Connections using COMPRESS=DEFLATE, kept to report the overall compression ratio
+compressed_connections = []
+
+class RunMetrics:
+    """Timings and counters of one run: seconds spent in each phase (connect, search, dedup, fetch, parse,
+    append, ...) overall and per folder, counters such as messages and bytes overall, per server and per
+    folder, and a latency histogram per IMAP command and server. Phase times of parallel workers add up,
+    so they show where the work goes rather than the wall-clock time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, mode=None):
+        """Start a new run."""
+        with self.lock:
+            self.mode = mode
+            self.started = time.time()
+            self.phases = {}  # (phase, folder or None for the total): [seconds, count]
+            self.counters = {}  # (name, host, folder), both None for the total: value
+            self.commands = {}  # (host, command): [count per bucket..., count above the last bucket, total seconds]
+
+    @contextmanager
+    def timer(self, phase, folder=None):
+        """Add the time spent in the with-block to *phase*, and to the folder's share of it if given."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                for key in {(phase, None), (phase, folder)}:
+                    entry = self.phases.setdefault(key, [0.0, 0])
+                    entry[0] += seconds
+                    entry[1] += 1
+
+    def count(self, name, amount=1, host=None, folder=None):
+        """Add to a counter, and to the server's or folder's share of it if given."""
+        with self.lock:
+            for key in {(name, None, None), (name, host, None), (name, None, folder)}:
+                self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe_command(self, host, command, seconds):
+        """Record how long a server took to complete a command."""
+        with self.lock:
+            entry = self.commands.setdefault((host, command), [0] * (len(LATENCY_BUCKETS) + 1) + [0.0])
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            entry[bucket] += 1
+            entry[-1] += seconds
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.phases), dict(self.counters), {key: list(entry) for key, entry in self.commands.items()}
+
+    def report(self):
+        """Return the metrics as a dictionary, ready to be written as JSON."""
+        phases, counters, commands = self.snapshot()
+        report = {"mode": self.mode, "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                  "duration_seconds": round(time.time() - self.started, 3), "phases": {}, "counters": {},
+                  "folders": {}, "hosts": {}}
+        for (phase, folder), (seconds, count) in sorted(phases.items(), key=lambda item: (item[0][1] or "", item[0][0])):
+            target = report["phases"] if folder is None else report["folders"].setdefault(folder, {"phases": {}, "counters": {}})["phases"]
+            target[phase] = {"seconds": round(seconds, 3), "count": count}
+        for (name, host, folder), value in sorted(counters.items(), key=lambda item: tuple(part or "" for part in item[0])):
+            if host is not None:
+                report["hosts"].setdefault(host, {"counters": {}, "commands": {}})["counters"][name] = value
+            elif folder is not None:
+                report["folders"].setdefault(folder, {"phases": {}, "counters": {}})["counters"][name] = value
+            else:
+                report["counters"][name] = value
+        for (host, command), entry in sorted(commands.items()):
+            count = sum(entry[:-1])
+            report["hosts"].setdefault(host, {"counters": {}, "commands": {}})["commands"][command] = {
+                "count": count, "seconds": round(entry[-1], 3), "mean_seconds": round(entry[-1] / count, 4),
+                "buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], entry[:-1]))}
+
+        # Round trips per message handled, over every server involved
+        round_trips = sum(sum(entry[:-1]) for entry in commands.values())
+        messages = sum(report["counters"].get(name, 0) for name in ("messages_transferred", "messages_backed_up", "messages_restored", "duplicates"))
+        report["round_trips"] = round_trips
+        report["round_trips_per_message"] = round(round_trips / messages, 3) if messages else None
+        return report
+
+    def write_json(self, path):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text format. Totals and their per-server and per-folder shares
+        are separate metrics, so summing a metric never counts anything twice. The file is replaced in one
+        step, so a collector never reads a half-written file."""
+        phases, counters, commands = self.snapshot()
+        mode = {"mode": self.mode}
+        lines = ["# HELP imap_transfer_run_duration_seconds Wall-clock duration of the run.",
+                 "# TYPE imap_transfer_run_duration_seconds gauge",
+                 f"imap_transfer_run_duration_seconds{prometheus_labels(**mode)} {time.time() - self.started:.3f}"]
+
+        for scope, selected in (("", lambda folder: folder is None), ("folder_", lambda folder: folder is not None)):
+            entries = sorted((key, value) for key, value in phases.items() if selected(key[1]))
+            if entries:
+                lines += [f"# HELP imap_transfer_{scope}phase_seconds_total Seconds spent per phase, summed over connections.",
+                          f"# TYPE imap_transfer_{scope}phase_seconds_total counter"]
+                lines += [f"imap_transfer_{scope}phase_seconds_total{prometheus_labels(**mode, phase=phase, folder=folder)} {seconds:.3f}"
+                          for (phase, folder), (seconds, _) in entries]
+
+        for name in sorted({name for name, _, _ in counters}):
+            for scope, index in (("", None), ("host_", 1), ("folder_", 2)):
+                entries = sorted((key, value) for key, value in counters.items()
+                                 if key[0] == name and (key[1] is None and key[2] is None if index is None else key[index] is not None))
+                if entries:
+                    lines.append(f"# TYPE imap_transfer_{scope}{name}_total counter")
+                    lines += [f"imap_transfer_{scope}{name}_total{prometheus_labels(**mode, host=host, folder=folder)} {value}"
+                              for (_, host, folder), value in entries]
+
+        if commands:
+            lines += ["# HELP imap_transfer_command_duration_seconds Time until the server completed an IMAP command.",
+                      "# TYPE imap_transfer_command_duration_seconds histogram"]
+        for (host, command), entry in sorted(commands.items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"], entry[:-1]):
+                cumulative += count
+                lines.append(f"imap_transfer_command_duration_seconds_bucket{prometheus_labels(**mode, host=host, command=command, le=bound)} {cumulative}")
+            lines.append(f"imap_transfer_command_duration_seconds_sum{prometheus_labels(**mode, host=host, command=command)} {entry[-1]:.6f}")
+            lines.append(f"imap_transfer_command_duration_seconds_count{prometheus_labels(**mode, host=host, command=command)} {cumulative}")
+
+        with open(path + ".tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def print_summary(self):
+        """Print where the time went, per phase and per server."""
+        report = self.report()
+        if report["phases"]:
+            print("\nTime by phase (summed over connections): " +
+                  ", ".join(f"{phase} {entry['seconds']:.1f}s" for phase, entry in
+                            sorted(report["phases"].items(), key=lambda item: -item[1]["seconds"])))
+        for host, entry in report["hosts"].items():
+            commands = entry["commands"].values()
+            count = sum(command["count"] for command in commands)
+            if count:
+                print(f"{host}: {count} commands, {sum(command['seconds'] for command in commands) / count * 1000:.1f} ms average, "
+                      f"{entry['counters'].get('bytes_received', 0) / (1024 * 1024):.2f} MB received, "
+                      f"{entry['counters'].get('bytes_sent', 0) / (1024 * 1024):.2f} MB sent")
+        if report["round_trips_per_message"] is not None:
+            print(f"Round trips per message: {report['round_trips_per_message']}")
+
+def prometheus_labels(**labels):
+    """Format labels for the Prometheus text format, leaving out those that are None."""
+    pairs = []
+    for key, value in labels.items():
+        if value is not None:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# Metrics of the current run
+metrics = RunMetrics()
+
+def write_metrics(report_path=METRICS_REPORT, textfile_path=METRICS_TEXTFILE):
+    """Print a short summary of the run's metrics and write the report and the textfile."""
+    metrics.print_summary()
+    try:
+        metrics.write_json(report_path)
+        metrics.write_prometheus(textfile_path)
+        print(f"Metrics written to {report_path} and {textfile_path}")
+    except OSError as e:
+        print(f"Could not write the metrics: {e}")
+
+class DeflateSocket:
+    """Stands in for the socket of a connection that enabled COMPRESS=DEFLATE: data sent is compressed,
+    data received is inflated, and both are counted before and after compression. Anything else is
+    passed through to the real socket."""
+
+    def __init__(self, sock, level=WIRE_COMPRESSION_LEVEL):
+        self.sock = sock
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.pending = memoryview(b'')
+        self.plain_bytes = 0
+        self.wire_bytes = 0
+
+    def sendall(self, data):
+        compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.sock.sendall(compressed)
+        self.plain_bytes += len(data)
+        self.wire_bytes += len(compressed)
+
+    def recv_into(self, buffer):
+        """Fill *buffer* with inflated data, reading from the socket as needed. Returns the byte count, 0 at EOF."""
+        while not self.pending:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return 0
+            self.pending = memoryview(self.decompressor.decompress(chunk))
+            self.wire_bytes += len(chunk)
+            self.plain_bytes += len(self.pending)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class DeflateReader(io.RawIOBase):
+    """Raw stream over a DeflateSocket; buffered, it replaces the connection's file for reading responses."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.sock.recv_into(buffer)
+
+def enable_compression(client):
+    """Switch a logged-in connection to COMPRESS=DEFLATE. Returns True if the server accepted it.
+    IMAPClient has no command for it, so it is sent through its imaplib connection."""
+    imap = client._imap
+    tag = imap._new_tag()
+    imap.send(tag + b' COMPRESS DEFLATE\r\n')
+    typ, _ = imap._command_complete('COMPRESS', tag)
+    if typ != 'OK':
+        return False
+    imap.file.close()
+    imap.sock = DeflateSocket(imap.sock)
+    imap.file = io.BufferedReader(DeflateReader(imap.sock), 65536)
+    with connection_lock:
+        compressed_connections.append(imap.sock)
+    return True
+
+def compression_ratio():
+    """Return how many bytes of IMAP traffic each byte on the wire carried, or None without compressed connections."""
+    with connection_lock:
+        plain_bytes = sum(sock.plain_bytes for sock in compressed_connections)
+        wire_bytes = sum(sock.wire_bytes for sock in compressed_connections)
+    return plain_bytes / wire_bytes if wire_bytes else None
+
+class SessionReusingContext(ssl.SSLContext):
+    """SSL context that offers the host's previous TLS session when connecting, so a reconnect
+    resumes the session instead of doing a full handshake."""
+    session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None and "session" not in kwargs:
+            kwargs["session"] = self.session
+        return super().wrap_socket(sock, *args, **kwargs)
+
+def tls_context(host):
+    """Return the shared TLS context of a host, verifying certificates like the IMAPClient default."""
+    with connection_lock:
+        if host not in tls_contexts:
+            context = SessionReusingContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_default_certs()
+            tls_contexts[host] = context
+        return tls_contexts[host]
+
+def instrument_connection(client, host):
+    """Count the bytes and commands of a connection and time every command until the server completed it.
+    Everything imaplib sends and reads goes through a few methods of its connection, which are wrapped.
+    Commands sent without imaplib's _command (pipelined or batched ones) are timed from when the response is awaited."""
+    imap = client._imap
+    send, read, readline = imap.send, imap.read, imap.readline
+    command, command_complete = imap._command, imap._command_complete
+    started = {}
+
+    def counted_send(data):
+        send(data)
+        metrics.count("bytes_sent", len(data), host=host)
+
+    def counted_read(size):
+        data = read(size)
+        metrics.count("bytes_received", len(data), host=host)
+        return data
+
+    def counted_readline():
+        line = readline()
+        metrics.count("bytes_received", len(line), host=host)
+        return line
+
+    def timed_command(name, *args):
+        start = time.perf_counter()
+        tag = command(name, *args)
+        started[tag] = start
+        return tag
+
+    def timed_command_complete(name, tag):
+        start = started.pop(tag, None) or time.perf_counter()
+        try:
+            return command_complete(name, tag)
+        finally:
+            metrics.observe_command(host, (name.decode() if isinstance(name, bytes) else name).upper(), time.perf_counter() - start)
 
-# Source account details
-if backup_option == '1':
-    source_host = input("Enter the source host (IMAP server): ")
-    source_username = input("Enter the source username: ")
-    source_password = getpass("Enter the source password: ")
-elif backup_option == '2':
-    source_host = input("Enter the source host (IMAP server): ")
-    source_username = input("Enter the source username: ")
-    source_password = getpass("Enter the source password: ")
-else:
-    pass
-
-# Destination account details if transfer option is chosen
-if backup_option == '1':
-    dest_host = input("Enter the destination host (IMAP server): ")
-    dest_username = input("Enter the destination username: ")
-    dest_password = getpass("Enter the destination password: ")
-
-# Prepare backup file if backup option is chosen
-if backup_option == '2':
-    backup_filename = "email_backup.zip"
-    backup_mailboxes = []
+    imap.send, imap.read, imap.readline = counted_send, counted_read, counted_readline
+    imap._command, imap._command_complete = timed_command, timed_command_complete
 
 # Function to try to connect with SSL, then with TLS if SSL fails
 def connect_imap(host, username, password):
-    for port, ssl in [(993, True), (143, False)]:
+    """Connect and log in, trying SSL on port 993 and then plain IMAP on 143.
+    The combination that worked is tried first next time and the TLS session is resumed, so a reconnect
+    skips both the probing and the full handshake. A rejected login is raised at once.
+    Unless turned off, traffic is compressed when the server supports COMPRESS=DEFLATE."""
+    with metrics.timer("connect"):
+        client = open_connection(host, username, password)
+    metrics.count("connections", host=host)
+    return client
+
+def open_connection(host, username, password):
+    """Connect and log in for connect_imap, trying the endpoint that worked last time first."""
+    endpoints = [(993, True), (143, False)]
+    if host in connection_endpoints:
+        endpoints = [connection_endpoints[host]] + [endpoint for endpoint in endpoints if endpoint != connection_endpoints[host]]
+    for port, use_ssl in endpoints:
+        try:
+            client = IMAPClient(host, port=port, use_uid=True, ssl=use_ssl, ssl_context=tls_context(host) if use_ssl else None)
+        except Exception:
+            continue
+        instrument_connection(client, host)
         try:
-            client = IMAPClient(host, port=port, use_uid=True, ssl=ssl)
             client.login(username, password)
-            return client
-        except:
+        except LoginError:
+            client.shutdown()
+            raise
+        except Exception:
+            client.shutdown()
             continue
-    raise ValueError(f"Could not connect to {host} with the provided credentials")
+        # Commands are written in one piece, so there is nothing to gain from Nagle's algorithm
+        client._imap.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection_endpoints[host] = (port, use_ssl)
+        if use_ssl:
+            tls_context(host).session = client._imap.sock.session
+        if wire_compression and client.has_capability('COMPRESS=DEFLATE'):
+            enable_compression(client)
+        client.last_activity = time.monotonic()
+        return client
+    raise ConnectionError(f"Could not connect to {host} with the provided credentials")
+
+class ConnectionPool:
+    """Logged-in connections to one account that workers borrow and give back, so they do not each pay
+    for connecting, the TLS handshake and LOGIN. Idle connections remember which folder they have selected."""
+
+    def __init__(self, host, username, password):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.idle = []  # (client, selected folder)
+        self.lock = threading.Lock()
+
+    def connect(self, folder=None):
+        client = connect_imap(self.host, self.username, self.password)
+        if folder:
+            client.select_folder(folder)
+        return client
+
+    def warm(self, count, folder=None):
+        """Open connections in parallel until *count* are idle, each with *folder* already selected."""
+        with self.lock:
+            missing = count - len(self.idle)
+        if missing <= 0:
+            return
+        with ThreadPoolExecutor(max_workers=missing) as executor:
+            futures = [executor.submit(self.connect, folder) for _ in range(missing)]
+        for future in futures:
+            try:
+                self.checkin(future.result(), folder)
+            except Exception as e:
+                print(f"\nWarning: Could not open a connection to {self.host}: {e}")
+
+    def checkout(self, folder=None):
+        """Borrow a connection with *folder* selected, opening a new one if none is idle.
+        A connection that has the folder selected and was used recently is handed out as it is;
+        otherwise the folder is selected again, which also proves the connection is still alive."""
+        with self.lock:
+            entry = None
+            if self.idle:
+                same_folder = [idx for idx, (_, selected) in enumerate(self.idle) if selected == folder]
+                entry = self.idle.pop(same_folder[0] if same_folder else -1)
+        if entry is None:
+            return self.connect(folder)
+
+        client, selected = entry
+        if folder and (selected != folder or time.monotonic() - getattr(client, "last_activity", 0) >= LIVENESS_IDLE_SECONDS):
+            try:
+                client.select_folder(folder)
+                client.last_activity = time.monotonic()
+            except Exception:
+                client.shutdown()
+                return self.connect(folder)
+        return client
+
+    def checkin(self, client, folder=None):
+        """Give a connection back, noting the folder it has selected."""
+        with self.lock:
+            self.idle.append((client, folder))
+
+    def close(self):
+        """Log out all idle connections."""
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for client, _ in idle:
+            try:
+                client.logout()
+            except Exception:
+                pass
+
+connection_pools = {}
+
+def get_pool(host, username, password):
+    """Return the connection pool of an account, creating it on first use."""
+    with connection_lock:
+        if (host, username) not in connection_pools:
+            connection_pools[(host, username)] = ConnectionPool(host, username, password)
+        return connection_pools[(host, username)]
+
+def close_pools():
+    """Log out the idle connections of every pool."""
+    for pool in list(connection_pools.values()):
+        pool.close()
 
 def ensure_connection(client, host, username, password, current_folder=None):
-    """Ensure the IMAP connection is alive, reconnect if necessary."""
+    """Ensure the IMAP connection is alive, reconnect if necessary.
+    A connection that completed a command recently is known to be alive, so the NOOP check is only
+    sent after LIVENESS_IDLE_SECONDS of silence or after a failed command."""
+    if time.monotonic() - getattr(client, "last_activity", 0) < LIVENESS_IDLE_SECONDS:
+        return client
     try:
         # Try a simple NOOP command to check if connection is alive
         client.noop()
+        client.last_activity = time.monotonic()
         return client
     except Exception:
-        # Connection is dead, reconnect
+        # Connection is dead: close its socket, then reconnect
         print(f"\nConnection lost. Reconnecting to {host}...")
+        metrics.count("reconnects", host=host)
+        try:
+            client.shutdown()
+        except Exception:
+            pass
         try:
-            new_client = connect_imap(host, username, password)
-            if current_folder:
-                new_client.select_folder(current_folder)
+            new_client = get_pool(host, username, password).checkout(current_folder)
             print("Reconnected successfully.")
             return new_client
         except Exception as e:
             print(f"Failed to reconnect: {e}")
             raise
 
-def safe_search(client, host, username, password, current_folder, criteria, max_retries=3):
-    """Safely execute a search operation with retry and reconnection logic.
-    Returns tuple: (search_results, updated_client)"""
+# Health of each server, shared by all connections to it: failures in a row and when requests may resume
+host_health = {}
+host_health_lock = threading.Lock()
+
+def is_throttled(error):
+    """Tell whether an error is the server asking us to slow down."""
+    text = str(error).upper()
+    return any(response in text for response in THROTTLE_RESPONSES)
+
+def is_transient_error(error):
+    """Tell whether an error is worth retrying: dropped connections, timeouts, and temporary refusals
+    such as [UNAVAILABLE] or [THROTTLED]. Failed logins, bad commands and rejected messages are fatal."""
+    if isinstance(error, LoginError):
+        return False
+    if isinstance(error, (IMAPClientAbortError, OSError, EOFError)):
+        return True
+    text = str(error).upper()
+    return any(response in text for response in TRANSIENT_RESPONSES)
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, limit=RETRY_MAX_DELAY):
+    """Exponential backoff with jitter: about base * 2^attempt seconds, randomised so that
+    connections that failed together do not retry together."""
+    delay = min(limit, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def wait_for_host(host):
+    """Sleep while the server is paused after a rate limit response."""
+    with host_health_lock:
+        resume_at = host_health.get(host, {}).get("resume_at", 0)
+    pause = resume_at - time.monotonic()
+    if pause > 0:
+        time.sleep(pause)
+
+def record_host_result(host, error=None, attempt=0):
+    """Update the shared health of a server after a command. A rate limit pauses every connection to the
+    server, and too many failures in a row open the circuit breaker, stopping the run instead of retrying
+    forever (the journal lets the next run resume). Rate limits do not count as failures: the server is
+    working, and the pause is how we adapt to it. Returns the pause in seconds set for a rate limit, or 0."""
+    with host_health_lock:
+        health = host_health.setdefault(host, {"failures": 0, "resume_at": 0})
+        if error is None:
+            health["failures"] = 0
+            return 0
+        if not is_throttled(error):
+            health["failures"] += 1
+            if health["failures"] >= CIRCUIT_BREAKER_FAILURES:
+                raise ConnectionError(f"{host} failed {health['failures']} times in a row, giving up for now (last error: {error})")
+            return 0
+        pause = backoff_delay(attempt, base=THROTTLE_BASE_DELAY, limit=RETRY_MAX_DELAY * 5)
+        health["resume_at"] = max(health["resume_at"], time.monotonic() + pause)
+        return pause
+
+def with_retries(client, host, username, password, current_folder, operation, description, max_retries=RETRY_ATTEMPTS):
+    """Run operation(client) under the shared retry policy: transient errors are retried with exponential
+    backoff and jitter, rate limits pause all connections to the server, fatal errors are raised at once.
+    Returns tuple: (operation_result, updated_client)"""
     for attempt in range(max_retries):
+        wait_for_host(host)
         try:
             client = ensure_connection(client, host, username, password, current_folder)
-            result = client.search(criteria)
+            result = operation(client)
+            client.last_activity = time.monotonic()
+            record_host_result(host)
             return result, client
         except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Search failed (attempt {attempt + 1}/{max_retries}), retrying...")
-                time.sleep(2)
-                continue
-            else:
+            # Have the next attempt check the connection before using it
+            client.last_activity = 0
+            if not is_transient_error(e):
                 raise
+            metrics.count("retries", host=host)
+            pause = record_host_result(host, e, attempt)
+            if attempt == max_retries - 1:
+                raise
+            if pause:
+                metrics.count("throttled", host=host)
+                print(f"\n{host} is rate limiting requests ({e}), pausing for {pause:.0f}s...")
+            else:
+                delay = backoff_delay(attempt)
+                print(f"\n{description} failed (attempt {attempt + 1}/{max_retries}): {e}. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
 
-def safe_append(client, host, username, password, current_folder, mailbox, message_bytes, flags=None, max_retries=3):
+def safe_search(client, host, username, password, current_folder, criteria, max_retries=RETRY_ATTEMPTS):
+    """Safely execute a search operation with retry and reconnection logic.
+    Returns tuple: (search_results, updated_client)"""
+    return with_retries(client, host, username, password, current_folder,
+                        lambda client: client.search(criteria), "Search", max_retries)
+
+def safe_append(client, host, username, password, current_folder, mailbox, message_bytes, flags=None, max_retries=RETRY_ATTEMPTS):
     """Safely execute an append operation with retry and reconnection logic.
     Returns tuple: (append_result, updated_client)"""
-    for attempt in range(max_retries):
-        try:
-            client = ensure_connection(client, host, username, password, current_folder)
-            result = client.append(mailbox, message_bytes, flags=flags)
-            return result, client
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Append failed (attempt {attempt + 1}/{max_retries}), retrying...")
-                time.sleep(2)
-                continue
-            else:
-                raise
+    return with_retries(client, host, username, password, current_folder,
+                        lambda client: client.append(mailbox, message_bytes, flags=flags), "Append", max_retries)
 
-def safe_fetch(client, host, username, password, current_folder, msg_id, data_items, max_retries=3):
+def safe_fetch(client, host, username, password, current_folder, msg_id, data_items, max_retries=RETRY_ATTEMPTS):
     """Safely execute a fetch operation with retry and reconnection logic.
     Returns tuple: (fetch_results, updated_client)"""
-    for attempt in range(max_retries):
+    return with_retries(client, host, username, password, current_folder,
+                        lambda client: client.fetch(msg_id, data_items), "Fetch", max_retries)
+
+def safe_select(client, host, username, password, folder, max_retries=RETRY_ATTEMPTS):
+    """Safely select a folder with retry and reconnection logic; a new connection comes with the folder selected.
+    Returns tuple: (select_result, updated_client)"""
+    return with_retries(client, host, username, password, folder,
+                        lambda client: client.select_folder(folder), "Select", max_retries)
+
+def append_batch(client, mailbox, messages, results=None):
+    """Append several messages to one mailbox with as few round trips as the server allows.
+    With MULTIAPPEND (RFC 3502) all messages go in one APPEND command; otherwise the APPEND commands
+    are pipelined and the responses read afterwards. Both need non-synchronising literals (LITERAL+,
+    or LITERAL- for messages up to 4 KB) so nothing waits for a continuation; without them, or for a
+    single message, one regular APPEND per message is sent.
+    *messages* is a list of (message_bytes, flags). Returns a result per message, in order: the
+    destination UID (None if the server did not report it), or False if the server rejected the message.
+    The results are added to *results*, if given, as the server answers, so when the connection breaks
+    the caller still knows which messages were confirmed before it did."""
+    results = [] if results is None else results
+    literal_plus = client.has_capability('LITERAL+')
+    literal_minus = client.has_capability('LITERAL-') and all(len(raw) <= LITERAL_MINUS_MAX_BYTES for raw, _ in messages)
+    if len(messages) == 1 or not (literal_plus or literal_minus):
+        for raw, flags in messages:
+            results.append(parse_append_uid(client.append(mailbox, raw, flags=flags)))
+        return results
+
+    imap = client._imap
+    folder = client._normalise_folder(mailbox)
+    folder = folder.encode() if isinstance(folder, str) else folder
+    literals = [seq_to_parenstr(flags).encode() + b' {%d+}\r\n' % len(raw) + raw for raw, flags in messages]
+
+    if client.has_capability('MULTIAPPEND'):
+        tag = imap._new_tag()
+        imap.send(tag + b' APPEND ' + folder + b' ' + b' '.join(literals) + b'\r\n')
+        typ, data = imap._command_complete('APPEND', tag)
+        if typ != 'OK':
+            results.extend([False] * len(messages))
+            return results
+        match = re.search(rb'\[APPENDUID \d+ ([\d,:]+)\]', data[-1] or b'')
+        uids = parse_uid_set(match.group(1).decode()) if match else []
+        results.extend(uids if len(uids) == len(messages) else [None] * len(messages))
+        return results
+
+    tags = [imap._new_tag() for _ in messages]
+    imap.send(b''.join(tag + b' APPEND ' + folder + b' ' + literal + b'\r\n' for tag, literal in zip(tags, literals)))
+    for tag in tags:
+        typ, data = imap._command_complete('APPEND', tag)
+        results.append(parse_append_uid(data[-1]) if typ == 'OK' else False)
+    return results
+
+def find_dest_uids(client, host, username, password, current_folder, message_ids):
+    """Look up messages in the selected folder by Message-ID: with one HEADER SEARCH each when there are
+    few (non-ASCII Message-IDs cannot be searched for), otherwise by fetching the folder's Message-IDs in bulk.
+    Returns tuple: ({message_id: [uid, ...]}, updated_client); Message-IDs that were not found are left out."""
+    found = {}
+    if len(message_ids) <= MESSAGE_ID_SEARCH_MAX:
+        for message_id in message_ids:
+            if message_id.isascii():
+                uids, client = safe_search(client, host, username, password, current_folder, ['HEADER', 'Message-ID', message_id])
+                if uids:
+                    found[message_id] = uids
+        return found, client
+    messages, client = safe_search(client, host, username, password, current_folder, 'ALL')
+    by_uid, client = fetch_message_ids(client, host, username, password, current_folder, messages)
+    for uid, message_id in by_uid.items():
+        if message_id in message_ids:
+            found.setdefault(message_id, []).append(uid)
+    return found, client
+
+def find_appended(client, host, username, password, current_folder, raw_message):
+    """Look for a message in the selected destination folder by its Message-ID, to learn whether an APPEND
+    whose answer was lost to a broken connection was stored anyway.
+    Returns tuple: (destination UID, or False if it is not there or cannot be looked up, updated_client)"""
+    message_id = extract_message_id(raw_message)
+    if not message_id:
+        return False, client
+    found, client = find_dest_uids(client, host, username, password, current_folder, {message_id})
+    return (max(found[message_id]) if message_id in found else False), client
+
+def safe_append_batch(client, host, username, password, current_folder, mailbox, messages):
+    """Append a batch of messages, appending again one at a time (with retries) the ones the batch did not store.
+    If the connection breaks during a batch, the messages the server had already confirmed are kept; the
+    ones left without an answer are looked up by Message-ID first, and only appended again if they are missing.
+    Returns tuple: (destination UIDs, updated_client)"""
+    results = []
+    try:
+        _, client = with_retries(client, host, username, password, current_folder,
+                                 lambda client: append_batch(client, mailbox, messages, results), "Batched append", max_retries=1)
+    except Exception as e:
+        print(f"\nBatched append failed ({e}), appending the remaining messages one at a time...")
+    answered = len(results)
+    results += [False] * (len(messages) - answered)
+
+    for idx, (raw, flags) in enumerate(messages):
+        if idx >= answered:
+            results[idx], client = find_appended(client, host, username, password, current_folder, raw)
+        if results[idx] is False:
+            append_response, client = safe_append(client, host, username, password, current_folder, mailbox, raw, flags=flags)
+            results[idx] = parse_append_uid(append_response)
+    return results, client
+
+def append_stream(client, mailbox, stream, flags=(), chunk_size=SPOOL_PART_BYTES):
+    """Append a message read from a file in chunks, so it is never in memory in one piece.
+    IMAPClient only appends bytes, so the command is sent through its imaplib connection; with LITERAL+
+    the message follows the command at once, otherwise after the server's go-ahead.
+    Returns the server's response text, like IMAPClient.append."""
+    imap = client._imap
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(0)
+    folder = client._normalise_folder(mailbox)
+    folder = folder.encode() if isinstance(folder, str) else folder
+    literal_plus = client.has_capability('LITERAL+')
+
+    tag = imap._new_tag()
+    imap.send(tag + b' APPEND ' + folder + b' ' + seq_to_parenstr(flags).encode() + (b' {%d+}\r\n' if literal_plus else b' {%d}\r\n') % size)
+    if not literal_plus:
+        # A tagged response instead of the go-ahead means the server refused the message
+        while imap._get_response():
+            if imap.tagged_commands[tag]:
+                break
+    if not imap.tagged_commands[tag]:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            imap.send(chunk)
+        imap.send(b'\r\n')
+    typ, data = imap._command_complete('APPEND', tag)
+    if typ != 'OK':
+        raise IMAPClientError(f"append failed: {data[-1]!r}")
+    return data[-1]
+
+def safe_append_stream(client, host, username, password, current_folder, mailbox, stream, flags=None, max_retries=RETRY_ATTEMPTS):
+    """Append a message from a file with retry and reconnection logic; every attempt starts from the beginning of the file.
+    Returns tuple: (append_result, updated_client)"""
+    return with_retries(client, host, username, password, current_folder,
+                        lambda client: append_stream(client, mailbox, stream, flags or ()), "Append", max_retries)
+
+def extract_message_id(raw_message):
+    """Return the stripped Message-ID of a raw message (or of its header block alone), or '' if it has none.
+    Only the header block is scanned, so no MIME tree is built and the message bytes are left untouched."""
+    header_end = raw_message.find(b'\r\n\r\n')
+    if header_end == -1:
+        header_end = raw_message.find(b'\n\n')
+    headers = raw_message if header_end == -1 else raw_message[:header_end]
+    # Unfold continuation lines before looking for the header
+    headers = re.sub(rb'\r?\n[ \t]', b' ', headers)
+    match = re.search(rb'^message-id[ \t]*:(.*)$', headers, re.IGNORECASE | re.MULTILINE)
+    if not match:
+        return ''
+    return match.group(1).strip().decode('utf-8', 'replace')
+
+def fetch_message_ids(client, host, username, password, current_folder, messages, batch_size=5000):
+    """Fetch the Message-ID header of the given messages in large batches.
+    Returns tuple: ({msg_id: message_id}, updated_client); messages without a Message-ID are left out."""
+    message_ids = {}
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        response, client = safe_fetch(client, host, username, password, current_folder, batch, ['BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'])
+        message_ids.update(parse_message_id_fetch(response))
+    return message_ids, client
+
+def parse_message_id_fetch(response):
+    """Pick the Message-IDs out of a FETCH response for BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)].
+    Returns {msg_id: message_id}; messages without a Message-ID are left out."""
+    message_ids = {}
+    for msg_id, data in response.items():
+        for key, value in data.items():
+            # Servers differ in how they echo the section name, so match on the prefix
+            if key.upper().startswith(b'BODY[HEADER.FIELDS') and value:
+                message_id = extract_message_id(value)
+                if message_id:
+                    message_ids[msg_id] = message_id
+    return message_ids
+
+def build_message_id_index(client, host, username, password, current_folder, first_uid=1, last_uid=None):
+    """Collect the Message-IDs of the messages in the selected folder into a set: all of them, or those
+    with UIDs from *first_uid* to *last_uid* (open-ended when None).
+    Headers are fetched in large batches so duplicate checks need no further round trips.
+    Returns tuple: (message_id_set, updated_client)"""
+    if first_uid <= 1 and last_uid is None:
+        messages, client = safe_search(client, host, username, password, current_folder, 'ALL')
+    else:
+        messages, client = safe_search(client, host, username, password, current_folder, ['UID', f"{first_uid}:{last_uid or '*'}"])
+        # "n:*" also matches the highest UID when it is below n
+        messages = [msg_id for msg_id in messages if msg_id >= first_uid]
+    message_ids, client = fetch_message_ids(client, host, username, password, current_folder, messages)
+    return set(message_ids.values()), client
+
+def fetch_message_sizes(client, host, username, password, current_folder, messages, batch_size=5000):
+    """Fetch RFC822.SIZE for the given messages in large batches.
+    Returns tuple: ({msg_id: size}, updated_client)"""
+    sizes = {}
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        response, client = safe_fetch(client, host, username, password, current_folder, batch, ['RFC822.SIZE'])
+        for msg_id, data in response.items():
+            sizes[msg_id] = data.get(b'RFC822.SIZE', 0)
+    return sizes, client
+
+def plan_fetch_chunks(messages, sizes, max_chunk_bytes=FETCH_CHUNK_BYTES, max_chunk_messages=FETCH_CHUNK_MESSAGES):
+    """Split messages into chunks that stay within a byte budget and a message count.
+    A single message larger than the budget gets a chunk of its own."""
+    chunks = []
+    chunk = []
+    chunk_bytes = 0
+    for msg_id in messages:
+        size = sizes.get(msg_id, 0)
+        if chunk and (chunk_bytes + size > max_chunk_bytes or len(chunk) >= max_chunk_messages):
+            chunks.append(chunk)
+            chunk = []
+            chunk_bytes = 0
+        chunk.append(msg_id)
+        chunk_bytes += size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def fetch_chunk(client, host, username, password, current_folder, chunk, data_items, max_retries=RETRY_ATTEMPTS):
+    """Fetch a chunk of messages with retries, bisecting it when it keeps failing.
+    This isolates a single bad message, which is reported and skipped. The halves are tried once
+    (a single message twice), so a bad message does not run up retries at every level.
+    Returns tuple: (fetch_results, updated_client)"""
+    try:
+        return safe_fetch(client, host, username, password, current_folder, chunk, data_items, max_retries)
+    except Exception as e:
+        # Only bisect when the server itself is reachable; otherwise give up on the run
+        client = ensure_connection(client, host, username, password, current_folder)
+        if len(chunk) == 1:
+            print(f"\nWarning: Could not fetch message {chunk[0]} from {current_folder}: {e}. Skipping.")
+            return {}, client
+        middle = len(chunk) // 2
+        halves = [chunk[:middle], chunk[middle:]]
+        first, client = fetch_chunk(client, host, username, password, current_folder, halves[0], data_items, 2 if len(halves[0]) == 1 else 1)
+        second, client = fetch_chunk(client, host, username, password, current_folder, halves[1], data_items, 2 if len(halves[1]) == 1 else 1)
+        first.update(second)
+        return first, client
+
+def iter_fetch_chunks(client, host, username, password, current_folder, messages, data_items, sizes):
+    """Fetch messages in byte-budgeted chunks and hand them out one by one as each chunk arrives.
+    Yields tuples: (msg_id, data_or_None, updated_client); data is None for messages that could not be fetched."""
+    for chunk in plan_fetch_chunks(messages, sizes):
+        with metrics.timer("fetch", current_folder):
+            response, client = fetch_chunk(client, host, username, password, current_folder, chunk, data_items)
+        metrics.count("messages_fetched", len(response), host=host, folder=current_folder)
+        metrics.count("bytes_fetched", sum(sizes.get(msg_id, 0) for msg_id in response), host=host, folder=current_folder)
+        for msg_id in chunk:
+            yield msg_id, response.get(msg_id), client
+
+def spool_message(client, host, username, password, current_folder, msg_id, part_size=SPOOL_PART_BYTES):
+    """Download one large message into a temporary file with partial fetches (BODY.PEEK[]<offset.length>),
+    so only one part is in memory at a time and a dropped connection only repeats the current part.
+    A message that cannot be fetched is reported and skipped, like in fetch_chunk.
+    Returns tuple: (data_or_None, updated_client); data holds the open file under b'SPOOL', the header
+    block under b'HEADER', and FLAGS and RFC822.SIZE like a fetch response."""
+    spool = tempfile.TemporaryFile()
+    data = {b'SPOOL': spool, b'HEADER': b'', b'FLAGS': (), b'RFC822.SIZE': 0}
+    try:
+        while True:
+            items = [f'BODY.PEEK[]<{data[b"RFC822.SIZE"]}.{part_size}>'] + (['FLAGS'] if not data[b'RFC822.SIZE'] else [])
+            response, client = safe_fetch(client, host, username, password, current_folder, [msg_id], items)
+            if msg_id not in response:
+                raise IMAPClientError("the message is gone")
+            # The section comes back as BODY[]<offset>
+            part = next((value for key, value in response[msg_id].items() if key.startswith(b'BODY[]')), None) or b''
+            if not data[b'RFC822.SIZE']:
+                header_end = part.find(b'\r\n\r\n')
+                data[b'HEADER'] = part if header_end == -1 else part[:header_end + 4]
+                data[b'FLAGS'] = response[msg_id].get(b'FLAGS', ())
+            spool.write(part)
+            data[b'RFC822.SIZE'] += len(part)
+            if len(part) < part_size:
+                return data, client
+    except Exception as e:
+        spool.close()
+        # Only skip the message when the server itself is reachable; otherwise give up on the run
+        client = ensure_connection(client, host, username, password, current_folder)
+        print(f"\nWarning: Could not fetch message {msg_id} from {current_folder}: {e}. Skipping.")
+        return None, client
+
+def load_message_id_index(client, host, username, password, current_folder, first_uid=1, last_uid=None):
+    """Build the Message-ID index for duplicate checks (see build_message_id_index), falling back to an empty index on failure.
+    Returns tuple: (message_id_set, updated_client)"""
+    try:
+        return build_message_id_index(client, host, username, password, current_folder, first_uid, last_uid)
+    except Exception as e:
+        print(f"\nWarning: Could not index existing messages in {current_folder}: {e}. Duplicates will not be detected.")
+        return set(), client
+
+def parse_append_uid(append_response):
+    """Return the destination UID from an APPENDUID response code (RFC 4315), or None if the server sent none."""
+    if isinstance(append_response, str):
+        append_response = append_response.encode()
+    match = re.search(rb'\[APPENDUID \d+ ([\d,:]+)\]', append_response or b'')
+    if not match:
+        return None
+    return int(re.split(rb'[,:]', match.group(1))[-1])
+
+def uid_set(uids):
+    """Format UIDs as a compact IMAP sequence set, e.g. [1, 2, 3, 7] -> '1:3,7'."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+def parse_uid_set(text):
+    """Expand an IMAP sequence set such as '1:3,7' into a list of UIDs, keeping the order given."""
+    uids = []
+    for part in text.split(","):
+        start, _, end = part.partition(":")
+        start, end = int(start), int(end or start)
+        uids.extend(range(start, end + 1) if start <= end else range(start, end - 1, -1))
+    return uids
+
+def parse_copy_uids(client, copy_response):
+    """Map source UIDs to destination UIDs from a COPYUID response code (RFC 4315), or {} if the server sent none.
+    The code comes with the tagged response for COPY, and usually in an untagged OK for MOVE."""
+    if isinstance(copy_response, str):
+        copy_response = copy_response.encode()
+    match = re.search(rb'\[COPYUID \d+ ([\d,:]+) ([\d,:]+)\]', copy_response or b'')
+    if match:
+        source_uids, dest_uids = match.group(1), match.group(2)
+    else:
+        untagged = client._imap.untagged_responses.pop('COPYUID', None)
+        match = re.match(rb'\d+ ([\d,:]+) ([\d,:]+)', untagged[-1]) if untagged else None
+        if not match:
+            return {}
+        source_uids, dest_uids = match.group(1), match.group(2)
+    return dict(zip(parse_uid_set(source_uids.decode()), parse_uid_set(dest_uids.decode())))
+
+class TransferJournal:
+    """SQLite record of every message already copied, so an interrupted transfer can resume without rechecking them.
+    Entries are keyed by source account, folder, UIDVALIDITY and UID; a folder's entries are dropped when its UIDVALIDITY changes."""
+
+    def __init__(self, path=TRANSFER_JOURNAL, commit_every=100):
+        self.lock = threading.Lock()
+        self.commit_every = commit_every
+        self.pending = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS folders (
+            source TEXT, folder TEXT, dest TEXT, dest_folder TEXT, uidvalidity INTEGER,
+            PRIMARY KEY (source, folder, dest, dest_folder))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS messages (
+            source TEXT, folder TEXT, dest TEXT, dest_folder TEXT, uidvalidity INTEGER, uid INTEGER,
+            message_id TEXT, dest_uid INTEGER,
+            PRIMARY KEY (source, folder, dest, dest_folder, uidvalidity, uid))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS sync_state (
+            source TEXT, folder TEXT, dest TEXT, dest_folder TEXT, uidvalidity INTEGER, uidnext INTEGER,
+            highestmodseq INTEGER, dest_uidvalidity INTEGER, dest_uidnext INTEGER,
+            PRIMARY KEY (source, folder, dest, dest_folder))""")
+        # Journals written before the destination watermarks were kept lack their columns
+        columns = {row[1] for row in self.db.execute("PRAGMA table_info(sync_state)")}
+        for column in ("dest_uidvalidity", "dest_uidnext"):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE sync_state ADD COLUMN {column} INTEGER")
+        self.db.commit()
+
+    def completed_uids(self, source, folder, dest, dest_folder, uidvalidity):
+        """Return the set of UIDs already copied for this folder pair, resetting the folder if UIDVALIDITY changed."""
+        with self.lock:
+            row = self.db.execute("SELECT uidvalidity FROM folders WHERE source=? AND folder=? AND dest=? AND dest_folder=?",
+                                  (source, folder, dest, dest_folder)).fetchone()
+            if row is None or row[0] != uidvalidity:
+                if row is not None:
+                    print(f"UIDVALIDITY of {folder} changed, discarding its journal entries.")
+                self.db.execute("DELETE FROM messages WHERE source=? AND folder=? AND dest=? AND dest_folder=?",
+                                (source, folder, dest, dest_folder))
+                self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, ?)",
+                                (source, folder, dest, dest_folder, uidvalidity))
+                self.db.commit()
+                return set()
+            rows = self.db.execute("SELECT uid FROM messages WHERE source=? AND folder=? AND dest=? AND dest_folder=? AND uidvalidity=?",
+                                   (source, folder, dest, dest_folder, uidvalidity))
+            return set(uid for (uid,) in rows)
+
+    def record(self, source, folder, dest, dest_folder, uidvalidity, uid, message_id, dest_uid=None):
+        """Mark a message as copied (or found to be a duplicate). Writes are committed in batches."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (source, folder, dest, dest_folder, uidvalidity, uid, message_id, dest_uid))
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.db.commit()
+                self.pending = 0
+
+    def copied_messages(self, source, folder, dest, dest_folder, uidvalidity, uids):
+        """Map source UIDs to their journal entries, as tuples (Message-ID, destination UID or None when the
+        server did not report it), leaving out UIDs that were not copied."""
+        wanted = set(uids)
+        with self.lock:
+            rows = self.db.execute("SELECT uid, message_id, dest_uid FROM messages WHERE source=? AND folder=? AND dest=? AND dest_folder=? AND uidvalidity=?",
+                                   (source, folder, dest, dest_folder, uidvalidity))
+            return {uid: (message_id, dest_uid) for uid, message_id, dest_uid in rows if uid in wanted}
+
+    def dest_message_ids(self, dest, dest_folder):
+        """Return the Message-IDs of every message copied into (or found in) a destination folder, from any source."""
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT message_id FROM messages WHERE dest=? AND dest_folder=? AND message_id != ''",
+                                   (dest, dest_folder))
+            return {message_id for (message_id,) in rows if message_id}
+
+    def sync_state(self, source, folder, dest, dest_folder):
+        """Return the watermarks stored after the last complete sync, or None: the source folder's UIDVALIDITY,
+        UIDNEXT and HIGHESTMODSEQ and the destination folder's UIDVALIDITY and UIDNEXT."""
+        with self.lock:
+            row = self.db.execute("SELECT uidvalidity, uidnext, highestmodseq, dest_uidvalidity, dest_uidnext FROM sync_state "
+                                  "WHERE source=? AND folder=? AND dest=? AND dest_folder=?",
+                                  (source, folder, dest, dest_folder)).fetchone()
+        if row is None:
+            return None
+        return {"uidvalidity": row[0], "uidnext": row[1], "highestmodseq": row[2], "dest_uidvalidity": row[3], "dest_uidnext": row[4]}
+
+    def save_sync_state(self, source, folder, dest, dest_folder, uidvalidity, uidnext, highestmodseq, dest_uidvalidity=None, dest_uidnext=None):
+        """Store the watermarks the next incremental sync starts from."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO sync_state (source, folder, dest, dest_folder, uidvalidity, uidnext, highestmodseq, "
+                            "dest_uidvalidity, dest_uidnext) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (source, folder, dest, dest_folder, uidvalidity, uidnext, highestmodseq, dest_uidvalidity, dest_uidnext))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def archive_compression(compresslevel, attachment=None):
+    """Pick the zip compression method for an archive entry: store it when compression is off, or when it is an
+    *attachment* (as described by split_message_parts) of an already compressed type kept in binary form.
+    Base64 or quoted-printable text of a compressed file still shrinks by about a quarter, so those are deflated."""
+    if compresslevel == 0:
+        return zipfile.ZIP_STORED
+    if (attachment and attachment["encoding"] not in ("base64", "quoted-printable")
+            and os.path.splitext(attachment["filename"])[1].lower() in PRECOMPRESSED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+def encode_archive_entry(name, data, password, compress_type, compresslevel):
+    """Compress and encrypt a single entry by writing it to an in-memory one-entry archive.
+    Returns tuple: (zip_info, local_record_bytes) where the record is the local header plus encrypted data."""
+    buffer = io.BytesIO()
+    with pyzipper.AESZipFile(buffer, "w", compression=compress_type, compresslevel=compresslevel or None, encryption=pyzipper.WZ_AES) as entry_zip:
+        entry_zip.setpassword(password)
+        entry_zip.writestr(name, data)
+        zip_info = entry_zip.infolist()[0]
+        record_end = entry_zip.start_dir
+    return zip_info, buffer.getvalue()[:record_end]
+
+class ParallelArchiveWriter:
+    """Compress and encrypt archive entries on a thread pool and add the finished entries to the archive in order.
+    zlib and the AES/HMAC primitives release the GIL, so several entries are encoded at once."""
+
+    def __init__(self, archive, password, workers=BACKUP_WORKERS, compresslevel=BACKUP_COMPRESSION_LEVEL, max_pending_bytes=BACKUP_PENDING_BYTES):
+        self.archive = archive
+        self.password = password
+        self.compresslevel = compresslevel
+        self.max_pending = workers * 4
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for future, _ in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+
+    def write(self, name, data, attachment=None):
+        """Queue an entry for encoding; finished entries are written once too many are waiting.
+        *attachment* is the split_message_parts entry of an attachment segment, used to pick the compression."""
+        future = self.executor.submit(encode_archive_entry, name, data, self.password, archive_compression(self.compresslevel, attachment), self.compresslevel)
+        self.pending.append((future, len(data)))
+        self.pending_bytes += len(data)
+        while self.pending and (len(self.pending) > self.max_pending or self.pending_bytes > self.max_pending_bytes):
+            self._commit_oldest()
+
+    def close(self):
+        """Write all remaining entries and stop the worker threads."""
+        while self.pending:
+            self._commit_oldest()
+        self.executor.shutdown()
+
+    def _commit_oldest(self):
+        future, size = self.pending.popleft()
+        self.pending_bytes -= size
+        zip_info, record = future.result()
+        archive = self.archive
+        # Append the encoded record where ZipFile.writestr would have written it
+        with archive._lock:
+            archive._writecheck(zip_info)
+            archive.fp.seek(archive.start_dir)
+            zip_info.header_offset = archive.fp.tell()
+            archive.fp.write(record)
+            archive.start_dir = archive.fp.tell()
+            archive.filelist.append(zip_info)
+            archive.NameToInfo[zip_info.filename] = zip_info
+            archive._didModify = True
+
+def split_message_parts(raw_message, min_part_bytes=PART_OBJECT_MIN_BYTES):
+    """Split a raw message into byte segments so that large and attached MIME parts get segments of their own.
+    Joining the segments gives back the original bytes exactly; a message that cannot be split is one segment.
+    Returns tuple: (segments, attachments) where each attachment is a dict with filename, segment index and encoding."""
+    segments = []
+    attachments = []
+    cursor = 0
+    for part in message_from_bytes(raw_message).walk():
+        if part.is_multipart():
+            continue
+        filename = part.get_filename()
+        payload = part.get_payload()
+        if not isinstance(payload, str) or (len(payload) < min_part_bytes and not filename):
+            continue
         try:
-            client = ensure_connection(client, host, username, password, current_folder)
-            result = client.fetch(msg_id, data_items)
-            return result, client
-        except Exception as e:
-            if attempt < max_retries - 1:
-                print(f"Fetch failed (attempt {attempt + 1}/{max_retries}), retrying...")
-                time.sleep(2)
+            # The parser keeps the encoded payload as surrogate-escaped ASCII, so this recovers the original bytes
+            payload = payload.encode('ascii', 'surrogateescape')
+        except UnicodeEncodeError:
+            continue
+        position = raw_message.find(payload, cursor) if payload else -1
+        if position == -1:
+            continue
+        if position > cursor:
+            segments.append(raw_message[cursor:position])
+        if filename:
+            attachments.append({"filename": filename, "segment": len(segments),
+                                "encoding": str(part.get('Content-Transfer-Encoding', '7bit')).strip().lower()})
+        segments.append(payload)
+        cursor = position + len(payload)
+    if cursor < len(raw_message) or not segments:
+        segments.append(raw_message[cursor:])
+    if b''.join(segments) != raw_message:
+        return [raw_message], []
+    return segments, attachments
+
+def is_manifest_backup(filename):
+    """Tell whether a zip file is a backup in the manifest layout, which incremental backups can build on."""
+    try:
+        with zipfile.ZipFile(filename) as archive:
+            return BACKUP_MANIFEST in archive.namelist()
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+class BackupChain:
+    """A backup archive opened together with the earlier archives it was made incrementally against (its parents).
+    The message lists of all archives are merged, and each object is read from whichever archive stores it.
+    Archives in the original layout (one .eml member per message) are supported as a chain of one."""
+
+    def __init__(self, filename, password):
+        self.archives = []  # (filename, archive, manifest or None), newest first
+        try:
+            while filename:
+                archive = pyzipper.AESZipFile(filename, "r", encryption=pyzipper.WZ_AES)
+                archive.pwd = password
+                manifest = json.loads(archive.read(BACKUP_MANIFEST)) if BACKUP_MANIFEST in archive.namelist() else None
+                self.archives.append((filename, archive, manifest))
+                parent = manifest.get("parent") if manifest else None
+                filename = os.path.join(os.path.dirname(filename), parent) if parent else None
+        except Exception:
+            self.close()
+            raise
+
+        self.objects = {}
+        for _, archive, _ in self.archives:
+            for name in archive.namelist():
+                if name.startswith("objects/"):
+                    self.objects.setdefault(name[len("objects/"):], archive)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def mailboxes(self):
+        """Merge the message lists of the chain, oldest archive first.
+        Returns {mailbox: [message_entry, ...]}; manifest entries also carry the UIDVALIDITY they were backed up under."""
+        mailboxes = {}
+        seen = set()
+        for _, archive, manifest in reversed(self.archives):
+            if manifest is None:
+                for zip_info in archive.infolist():
+                    if "/" in zip_info.filename and zip_info.filename.endswith(".eml"):
+                        mailboxes.setdefault(zip_info.filename.split("/", 1)[0], []).append(
+                            {"member": zip_info.filename, "size": zip_info.file_size, "archive": archive})
                 continue
+            for mailbox, folder in manifest["mailboxes"].items():
+                entries = mailboxes.setdefault(mailbox, [])
+                for entry in folder["messages"]:
+                    key = (mailbox, folder["uidvalidity"], entry["uid"])
+                    if key not in seen:
+                        seen.add(key)
+                        entries.append(dict(entry, uidvalidity=folder["uidvalidity"]))
+        return mailboxes
+
+    def read_message(self, entry):
+        """Return the raw bytes of one message entry, decrypting only the members it needs."""
+        if "member" in entry:
+            return entry["archive"].read(entry["member"])
+        return b''.join(self.objects[digest].read(f"objects/{digest}") for digest in entry["segments"])
+
+    def close(self):
+        for _, archive, _ in self.archives:
+            archive.close()
+
+def plan_worker_count(requested, source_host, dest_host, max_per_host=MAX_CONNECTIONS_PER_HOST):
+    """Cap the number of workers so that worker and control connections stay within the per-host limit.
+    Each worker holds one source and one destination connection; the control connections count too."""
+    uses = 2 if source_host.lower() == dest_host.lower() else 1
+    return max(1, min(requested, max_per_host // uses - 1))
+
+def sync_changed_flags(source_client, dest_client, folder, journal, state):
+    """Copy flag changes made since the last sync (CONDSTORE CHANGEDSINCE) onto the copies in the destination.
+    Copies are found by the destination UID the journal has from APPENDUID or COPYUID; the others (servers
+    without UIDPLUS, messages that were found as duplicates) are looked up by Message-ID, and the UIDs found
+    are journaled for next time. Messages whose copy cannot be found are reported.
+    Returns tuple: (updated_message_count, updated_source_client, updated_dest_client)"""
+    src_box, dest_box = folder["src_box"], folder["dest_box"]
+    source = f"{source_username}@{source_host}"
+    dest = f"{dest_username}@{dest_host}"
+    changed = source_client.fetch('1:*', ['FLAGS'], modifiers=[f"CHANGEDSINCE {state['highestmodseq']}"])
+    # Messages not copied yet have no journal entry; they get copied with their current flags anyway
+    copied = journal.copied_messages(source, src_box, dest, dest_box, folder["uidvalidity"], changed)
+    if not copied:
+        return 0, source_client, dest_client
+
+    _, dest_client = safe_select(dest_client, dest_host, dest_username, dest_password, dest_box)
+    dest_uids = {msg_id: [dest_uid] for msg_id, (_, dest_uid) in copied.items() if dest_uid}
+    lookups = {msg_id: message_id for msg_id, (message_id, dest_uid) in copied.items() if not dest_uid and message_id}
+    if lookups:
+        found, dest_client = find_dest_uids(dest_client, dest_host, dest_username, dest_password, dest_box, set(lookups.values()))
+        for msg_id, message_id in lookups.items():
+            if message_id in found:
+                dest_uids[msg_id] = found[message_id]
+                journal.record(source, src_box, dest, dest_box, folder["uidvalidity"], msg_id, message_id, max(found[message_id]))
+    if len(dest_uids) < len(copied):
+        print(f"\nWarning: {len(copied) - len(dest_uids)} messages in {src_box} have changed flags, but their copies in {dest_box} "
+              f"could not be found (no destination UID or Message-ID), so their flags were not updated.")
+
+    by_flags = {}
+    for msg_id, uids in dest_uids.items():
+        flags = tuple(filter_flags_for_append(changed[msg_id][b'FLAGS']))
+        by_flags.setdefault(flags, []).extend(uids)
+    for flags, uids in by_flags.items():
+        dest_client.set_flags(uids, flags, silent=True)
+    return len(dest_uids), source_client, dest_client
+
+def index_destination_folder(dest_client, dest_box, first_uid, dest_indexes, journal=None):
+    """Return the shared Message-ID index of a destination folder (see prepare_folder_transfer), making sure
+    it covers the messages from UID *first_uid* up; only the UIDs not indexed yet are fetched. An index that
+    does not start at the first UID also holds the Message-IDs the journal lists for the folder, which
+    stand for the messages earlier runs copied or found there.
+    Returns tuple: (message_id_set, updated_dest_client)"""
+    index = dest_indexes.setdefault(dest_box, {"message_ids": set(), "first_uid": None})
+    if index["first_uid"] is not None and index["first_uid"] <= first_uid:
+        return index["message_ids"], dest_client
+    _, dest_client = safe_select(dest_client, dest_host, dest_username, dest_password, dest_box)
+    last_uid = index["first_uid"] - 1 if index["first_uid"] is not None else None
+    message_ids, dest_client = load_message_id_index(dest_client, dest_host, dest_username, dest_password, dest_box, first_uid, last_uid)
+    index["message_ids"].update(message_ids)
+    if first_uid > 1 and index["first_uid"] is None and journal is not None:
+        index["message_ids"].update(journal.dest_message_ids(f"{dest_username}@{dest_host}", dest_box))
+    index["first_uid"] = first_uid
+    return index["message_ids"], dest_client
+
+def prepare_folder_transfer(source_client, dest_client, src_box, dest_box, workers, journal=None, incremental=False, dest_indexes=None):
+    """Gather everything the workers need to copy one folder: the source UIDs, their sizes and the
+    destination Message-ID index. UIDs the journal already lists as copied are skipped up front.
+    The index of each destination folder is built once and kept in *dest_indexes*, so folder pairs
+    that copy into the same destination folder share it and never store a message twice.
+    In incremental mode only UIDs above the last run's UIDNEXT are considered, flag changes since
+    the last HIGHESTMODSEQ are applied directly, and only destination messages that arrived since the
+    last run are indexed (the journal stands for the rest); an unchanged folder costs a single STATUS.
+    The remaining UIDs are split into work units so every worker gets a share; each large message
+    (LARGE_MESSAGE_BYTES and up) is a work unit of its own.
+    Returns tuple: (folder_state, work_units, updated_source_client, updated_dest_client)"""
+    # STATUS gives the watermarks without selecting; asking for HIGHESTMODSEQ also enables CONDSTORE
+    status_items = ['UIDVALIDITY', 'UIDNEXT'] + (['HIGHESTMODSEQ'] if source_client.has_capability('CONDSTORE') else [])
+    with metrics.timer("search", src_box):
+        status, source_client = with_retries(source_client, source_host, source_username, source_password, None,
+                                             lambda client: client.folder_status(src_box, status_items), "Status")
+
+    folder = {"src_box": src_box, "dest_box": dest_box, "uidvalidity": status.get(b'UIDVALIDITY'),
+              "uidnext": status.get(b'UIDNEXT'), "highestmodseq": status.get(b'HIGHESTMODSEQ'),
+              "dest_uidvalidity": None, "dest_uidnext": None,
+              "total": 0, "resumed": 0, "transferred": 0, "duplicates": 0, "flag_updates": 0, "size": 0, "message_ids": set(),
+              "skipped": []}
+    source = f"{source_username}@{source_host}"
+    dest = f"{dest_username}@{dest_host}"
+
+    state = journal.sync_state(source, src_box, dest, dest_box) if incremental and journal is not None else None
+    synced = bool(state and state["uidvalidity"] == folder["uidvalidity"] and state["uidnext"] and folder["uidnext"])
+    if synced:
+        # Only UIDs assigned since the last run can be new; the destination watermarks carry over if none are
+        folder["dest_uidvalidity"], folder["dest_uidnext"] = state["dest_uidvalidity"], state["dest_uidnext"]
+        messages = []
+        if folder["uidnext"] != state["uidnext"]:
+            with metrics.timer("search", src_box):
+                _, source_client = safe_select(source_client, source_host, source_username, source_password, src_box)
+                messages = [msg_id for msg_id in source_client.search(['UID', f"{state['uidnext']}:*"]) if msg_id >= state["uidnext"]]
+        if state["highestmodseq"] and folder["highestmodseq"] and folder["highestmodseq"] != state["highestmodseq"]:
+            with metrics.timer("flags", src_box):
+                _, source_client = safe_select(source_client, source_host, source_username, source_password, src_box)
+                folder["flag_updates"], source_client, dest_client = sync_changed_flags(source_client, dest_client, folder, journal, state)
+            metrics.count("flag_updates", folder["flag_updates"], folder=src_box)
+    else:
+        # Fetch all message IDs from source mailbox
+        with metrics.timer("search", src_box):
+            _, source_client = safe_select(source_client, source_host, source_username, source_password, src_box)
+            messages = source_client.search('ALL')
+    folder["total"] = len(messages)
+
+    # Skip the messages a previous run already copied
+    if journal is not None:
+        completed = journal.completed_uids(source, src_box, dest, dest_box, folder["uidvalidity"])
+        if completed:
+            messages = [msg_id for msg_id in messages if msg_id not in completed]
+            folder["resumed"] = folder["total"] - len(messages)
+            folder["total"] = len(messages)
+            metrics.count("messages_resumed", folder["resumed"], folder=src_box)
+
+    if not messages:
+        return folder, [], source_client, dest_client
+
+    # Fetch all sizes up front so bodies can be fetched in byte-budgeted chunks
+    with metrics.timer("search", src_box):
+        sizes, source_client = fetch_message_sizes(source_client, source_host, source_username, source_password, src_box, messages)
+
+    # Index the Message-IDs already present in the destination mailbox. After a sync of the same
+    # destination folder only the messages that arrived there since need their headers fetched
+    with metrics.timer("dedup", src_box):
+        dest_status, dest_client = with_retries(dest_client, dest_host, dest_username, dest_password, None,
+                                                lambda client: client.folder_status(dest_box, ['UIDVALIDITY', 'UIDNEXT']), "Status")
+        first_uid = 1
+        if synced and folder["dest_uidnext"] and folder["dest_uidvalidity"] == dest_status.get(b'UIDVALIDITY'):
+            first_uid = folder["dest_uidnext"]
+        # Saved for the next run as they are before this run adds anything
+        folder["dest_uidvalidity"], folder["dest_uidnext"] = dest_status.get(b'UIDVALIDITY'), dest_status.get(b'UIDNEXT')
+        folder["message_ids"], dest_client = index_destination_folder(dest_client, dest_box, first_uid, {} if dest_indexes is None else dest_indexes, journal)
+
+    # Large messages each get a work unit of their own, after the units of small messages
+    small = [msg_id for msg_id in messages if sizes.get(msg_id, 0) < LARGE_MESSAGE_BYTES]
+    large = [msg_id for msg_id in messages if sizes.get(msg_id, 0) >= LARGE_MESSAGE_BYTES]
+    unit_size = max(1, min(WORK_UNIT_MESSAGES, -(-len(small) // workers)))
+    work_units = [(folder, small[start:start + unit_size], sizes) for start in range(0, len(small), unit_size)]
+    work_units += [(folder, [msg_id], sizes) for msg_id in large]
+    return folder, work_units, source_client, dest_client
+
+def is_same_account(source_host, source_username, dest_host, dest_username):
+    """Tell whether source and destination are the same mailbox account, so folders can be copied on the server."""
+    return source_host.strip().lower() == dest_host.strip().lower() and source_username == dest_username
+
+def uncopied_messages(client, src_box, dest_box, messages, message_ids, first_uid):
+    """Tell which of *messages* have no copy among the messages that arrived in *dest_box* from UID
+    *first_uid* up, matching them by Message-ID; messages without one are taken as not copied.
+    Used to retry a COPY whose answer was lost, so the messages it did copy are not copied twice.
+    Sends its commands directly, for use inside a with_retries operation, and selects *src_box* again."""
+    client.select_folder(dest_box)
+    arrived = [uid for uid in client.search(['UID', f"{first_uid}:*"]) if uid >= first_uid]
+    copied = set(parse_message_id_fetch(client.fetch(arrived, ['BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)]'])).values()) if arrived else set()
+    client.select_folder(src_box)
+    return [msg_id for msg_id in messages if message_ids.get(msg_id) not in copied]
+
+def copy_folder_on_server(source_client, folder, work_units, pbar, journal=None, move=False):
+    """Copy a folder's remaining messages with UID COPY (or UID MOVE) in bulk UID sets, so no message data
+    passes through this machine. Messages whose Message-ID is already in the destination folder are skipped;
+    when moving, they are deleted from the source folder instead (with UIDPLUS, so that only they are expunged).
+    Commands are retried like all others. A MOVE can simply be sent again, as moved messages are gone from
+    the source; a COPY is only repeated for the messages the lost attempt did not copy (see uncopied_messages).
+    Returns the updated source client."""
+    source = f"{source_username}@{source_host}"
+    dest = f"{dest_username}@{dest_host}"
+    src_box, dest_box = folder["src_box"], folder["dest_box"]
+    messages = [msg_id for _, unit_messages, _ in work_units for msg_id in unit_messages]
+    sizes = work_units[0][2] if work_units else {}
+
+    with metrics.timer("dedup", src_box):
+        _, source_client = safe_select(source_client, source_host, source_username, source_password, src_box)
+        message_ids, source_client = fetch_message_ids(source_client, source_host, source_username, source_password, src_box, messages)
+
+    to_copy = []
+    duplicates = []
+    for msg_id in messages:
+        message_id = message_ids.get(msg_id)
+        if message_id and message_id in folder["message_ids"]:
+            folder["duplicates"] += 1
+            folder["size"] += sizes.get(msg_id, 0)
+            metrics.count("duplicates", folder=src_box)
+            if journal is not None:
+                journal.record(source, src_box, dest, dest_box, folder["uidvalidity"], msg_id, message_id, None)
+            duplicates.append(msg_id)
+            pbar.update(1)
+            continue
+        if message_id:
+            folder["message_ids"].add(message_id)
+        to_copy.append(msg_id)
+
+    for start in range(0, len(to_copy), SERVER_COPY_MESSAGES):
+        batch = to_copy[start:start + SERVER_COPY_MESSAGES]
+        attempts = []
+
+        def copy_batch(client):
+            pending = batch
+            if attempts and not move:
+                # Messages copied since the folder was prepared belong to this folder's earlier batches or to this one
+                pending = uncopied_messages(client, src_box, dest_box, batch, message_ids, folder["dest_uidnext"] or 1)
+            attempts.append(pending)
+            if not pending:
+                return {}
+            client._imap.untagged_responses.pop('COPYUID', None)
+            if move:
+                response = client.move(uid_set(pending), dest_box)
             else:
-                raise
-
-if backup_option == '1':
-    # Connect to the servers
-    with connect_imap(source_host, source_username, source_password) as source_client, \
-         connect_imap(dest_host, dest_username, dest_password) as dest_client:
-
-        auto_move = input("Do you want to automatically match mailboxes and move emails? (y/n): ").lower().strip() == "y"
-
-        if auto_move:
-            matches = match_mailboxes(source_client, dest_client)
+                response = client.copy(uid_set(pending), dest_box)
+            return parse_copy_uids(client, response)
+
+        with metrics.timer("copy", src_box):
+            dest_uids, source_client = with_retries(source_client, source_host, source_username, source_password, src_box,
+                                                    copy_batch, "Move" if move else "Copy")
+        metrics.count("messages_transferred", len(batch), folder=src_box)
+        metrics.count("bytes_copied_on_server", sum(sizes.get(msg_id, 0) for msg_id in batch), folder=src_box)
+
+        for msg_id in batch:
+            if journal is not None:
+                journal.record(source, src_box, dest, dest_box, folder["uidvalidity"], msg_id, message_ids.get(msg_id), dest_uids.get(msg_id))
+            folder["size"] += sizes.get(msg_id, 0)
+        folder["transferred"] += len(batch)
+        pbar.set_postfix({"Transferred": folder["transferred"], "Duplicates": folder["duplicates"], "Mode": "server-side"})
+        pbar.update(len(batch))
+
+    if move and duplicates:
+        if source_client.has_capability('UIDPLUS'):
+            for start in range(0, len(duplicates), SERVER_COPY_MESSAGES):
+                batch = duplicates[start:start + SERVER_COPY_MESSAGES]
+                _, source_client = with_retries(source_client, source_host, source_username, source_password, src_box,
+                                                lambda client: (client.delete_messages(batch), client.expunge(batch)), "Delete duplicates")
+            print(f"\n{len(duplicates)} messages of {src_box} were already in {dest_box} and were deleted from {src_box}.")
+        else:
+            print(f"\n{len(duplicates)} messages of {src_box} were already in {dest_box}; they were left in {src_box}, "
+                  f"since the server cannot expunge them alone (no UIDPLUS).")
+    return source_client
+
+class MessageQueue:
+    """Queue between the fetch and append stages, bounded by both message count and total bytes.
+    A message larger than the byte budget is still accepted when the queue is empty, so it cannot stall the pipeline."""
+
+    def __init__(self, max_messages=PIPELINE_QUEUE_MESSAGES, max_bytes=PIPELINE_QUEUE_BYTES):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.items = deque()
+        self.bytes = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def put(self, item, size=0):
+        """Add an item, waiting for room. Returns False if the queue was closed by the consumer."""
+        with self.condition:
+            while not self.closed and self.items and (len(self.items) >= self.max_messages or self.bytes + size > self.max_bytes):
+                self.condition.wait()
+            if self.closed:
+                return False
+            self.items.append((item, size))
+            self.bytes += size
+            self.condition.notify_all()
+            return True
+
+    def get_batch(self, max_items, max_bytes):
+        """Remove and return the oldest items, waiting until at least one is available, then taking
+        whatever else is already queued up to *max_items* items and *max_bytes* bytes."""
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            batch = []
+            batch_bytes = 0
+            while self.items and len(batch) < max_items and (not batch or batch_bytes + self.items[0][1] <= max_bytes):
+                item, size = self.items.popleft()
+                self.bytes -= size
+                batch_bytes += size
+                batch.append(item)
+            self.condition.notify_all()
+            return batch
+
+    def close(self):
+        """Stop accepting items and wake up a producer waiting for room."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+def fetch_stage(stage, work_queue, pipeline, lock, errors):
+    """Fetch side of a worker: take work units, fetch their messages in chunks and queue them for the append side.
+    The source connection is borrowed from the pool on the first work unit and kept in *stage*,
+    together with its selected folder, so the worker can give it back afterwards."""
+    try:
+        while not errors:
+            try:
+                folder, messages, sizes = work_queue.get_nowait()
+            except Empty:
+                break
+            src_box = folder["src_box"]
+            if stage["source_client"] is None:
+                stage["source_client"] = get_pool(source_host, source_username, source_password).checkout(src_box)
+            elif stage["source_folder"] != src_box:
+                _, stage["source_client"] = safe_select(stage["source_client"], source_host, source_username, source_password, src_box)
+            stage["source_folder"] = src_box
+
+            small = [msg_id for msg_id in messages if sizes.get(msg_id, 0) < LARGE_MESSAGE_BYTES]
+            fetched = iter_fetch_chunks(stage["source_client"], source_host, source_username, source_password, src_box, small, ['BODY.PEEK[]', 'FLAGS', 'RFC822.SIZE'], sizes)
+            for msg_id, data, stage["source_client"] in fetched:
+                if not pipeline.put((folder, msg_id, data), sizes.get(msg_id, 0)):
+                    return
+
+            # Large messages go through a temporary file. They count with their full size in the queue,
+            # so about one waits on disk per worker while the previous one is uploaded
+            for msg_id in messages:
+                if sizes.get(msg_id, 0) < LARGE_MESSAGE_BYTES:
+                    continue
+                with metrics.timer("fetch", src_box):
+                    data, stage["source_client"] = spool_message(stage["source_client"], source_host, source_username, source_password, src_box, msg_id)
+                if data is not None:
+                    metrics.count("messages_spooled", folder=src_box)
+                    metrics.count("messages_fetched", host=source_host, folder=src_box)
+                    metrics.count("bytes_fetched", data[b'RFC822.SIZE'], host=source_host, folder=src_box)
+                if not pipeline.put((folder, msg_id, data), sizes.get(msg_id, 0)):
+                    if data is not None:
+                        data[b'SPOOL'].close()
+                    return
+    except Exception as e:
+        with lock:
+            errors.append(e)
+    finally:
+        # Tell the append side there is nothing more to come
+        pipeline.put(None)
+
+def append_stage(stage, pipeline, lock, pbar, totals, journal=None):
+    """Append side of a worker: take fetched messages off the queue in batches, skip duplicates and
+    upload the rest together (see append_batch). The destination connection is borrowed from the pool
+    for the first batch and kept in *stage*, like the source connection."""
+    while True:
+        items = pipeline.get_batch(APPEND_BATCH_MESSAGES, APPEND_BATCH_BYTES)
+        batch = []
+        for item in items:
+            if item is None:
+                break
+            folder, msg_id, data = item
+            if data is None:
+                # Not journaled, so the next run tries the message again
+                with lock:
+                    folder["skipped"].append(msg_id)
+                    pbar.update(1)
+                continue
+            # A batch only ever targets one destination folder, and a spooled message is uploaded on its own
+            if batch and (batch[-1][0]["dest_box"] != folder["dest_box"] or b'SPOOL' in data or b'SPOOL' in batch[-1][2]):
+                stage["dest_client"] = append_messages(stage["dest_client"], batch, lock, pbar, totals, journal)
+                batch = []
+            if stage["dest_client"] is None:
+                stage["dest_client"] = get_pool(dest_host, dest_username, dest_password).checkout(folder["dest_box"])
+            elif stage["dest_folder"] != folder["dest_box"]:
+                _, stage["dest_client"] = safe_select(stage["dest_client"], dest_host, dest_username, dest_password, folder["dest_box"])
+            stage["dest_folder"] = folder["dest_box"]
+            batch.append(item)
+
+        if batch:
+            stage["dest_client"] = append_messages(stage["dest_client"], batch, lock, pbar, totals, journal)
+
+        if None in items:
+            return
+
+def append_messages(dest_client, batch, lock, pbar, totals, journal=None):
+    """Upload one batch of fetched (folder, msg_id, data) items bound for the same destination folder.
+    Each handled message is written to the journal. Returns the updated destination client."""
+    source = f"{source_username}@{source_host}"
+    dest = f"{dest_username}@{dest_host}"
+    dest_box = batch[0][0]["dest_box"]
+    # Phase times of a batch are counted for the source folder of its first message
+    src_box = batch[0][0]["src_box"]
+
+    with metrics.timer("parse", src_box):
+        message_ids = [extract_message_id(data[b'BODY[]'] if b'BODY[]' in data else data[b'HEADER']) for _, _, data in batch]
+
+    # Claim the Message-IDs under the lock so two workers never append the same message
+    to_append = []
+    handled = []
+    with metrics.timer("dedup", src_box), lock:
+        for (folder, msg_id, data), message_id in zip(batch, message_ids):
+            duplicate = bool(message_id) and message_id in folder["message_ids"]
+            if message_id and not duplicate:
+                folder["message_ids"].add(message_id)
+            if not duplicate:
+                to_append.append((folder, msg_id, data, message_id))
+            handled.append((folder, msg_id, data, message_id, duplicate))
+
+    dest_uids = {}
+    if to_append:
+        try:
+            with metrics.timer("append", src_box):
+                if b'SPOOL' in to_append[0][2]:
+                    data = to_append[0][2]
+                    append_response, dest_client = safe_append_stream(dest_client, dest_host, dest_username, dest_password, dest_box, dest_box,
+                                                                      data[b'SPOOL'], filter_flags_for_append(data[b'FLAGS']))
+                    results = [parse_append_uid(append_response)]
+                else:
+                    results, dest_client = safe_append_batch(dest_client, dest_host, dest_username, dest_password, dest_box, dest_box,
+                                                             [(data[b'BODY[]'], filter_flags_for_append(data[b'FLAGS'])) for _, _, data, _ in to_append])
+        except Exception:
+            with lock:
+                for folder, _, _, message_id in to_append:
+                    folder["message_ids"].discard(message_id)
+            raise
+        finally:
+            if b'SPOOL' in to_append[0][2]:
+                to_append[0][2][b'SPOOL'].close()
+        dest_uids = {msg_id: dest_uid for (_, msg_id, _, _), dest_uid in zip(to_append, results)}
+    elif b'SPOOL' in batch[0][2]:
+        # A spooled duplicate is not uploaded
+        batch[0][2][b'SPOOL'].close()
+
+    for folder, msg_id, data, message_id, duplicate in handled:
+        if journal is not None:
+            journal.record(source, folder["src_box"], dest, dest_box, folder["uidvalidity"], msg_id, message_id, dest_uids.get(msg_id))
+
+        size = data[b'RFC822.SIZE']
+        if duplicate:
+            metrics.count("duplicates", folder=folder["src_box"])
+        else:
+            metrics.count("messages_transferred", folder=folder["src_box"])
+            metrics.count("bytes_appended", size, host=dest_host, folder=folder["src_box"])
+        with lock:
+            if duplicate:
+                folder["duplicates"] += 1
+                totals["duplicates"] += 1
+            else:
+                folder["transferred"] += 1
+                totals["transferred"] += 1
+            folder["size"] += size
+            totals["size"] += size
+            postfix = {"Transferred": totals["transferred"], "Duplicates": totals["duplicates"],
+                       "Total Size": f"{totals['size'] / (1024 * 1024):.2f} MB"}
+            ratio = compression_ratio()
+            if ratio:
+                postfix["Compression"] = f"{ratio:.1f}x"
+            pbar.set_postfix(postfix)
+            pbar.update(1)
+    return dest_client
+
+def transfer_worker(work_queue, lock, pbar, totals, errors, journal=None):
+    """Worker: borrow a source and a destination connection and run a fetch thread and an append
+    stage side by side, so both servers stay busy while the bounded queue caps memory use."""
+    stage = {"source_client": None, "source_folder": None, "dest_client": None, "dest_folder": None}
+    pipeline = MessageQueue()
+    try:
+        fetcher = threading.Thread(target=fetch_stage, args=(stage, work_queue, pipeline, lock, errors), daemon=True)
+        fetcher.start()
+        try:
+            append_stage(stage, pipeline, lock, pbar, totals, journal)
+        finally:
+            # Unblock the fetch side if the append side stopped early
+            pipeline.close()
+            fetcher.join()
+    except Exception as e:
+        with lock:
+            errors.append(e)
+    finally:
+        # Healthy connections go back to the pools for the next folder or run
+        for host, username, password, client, folder in ((source_host, source_username, source_password, stage["source_client"], stage["source_folder"]),
+                                                          (dest_host, dest_username, dest_password, stage["dest_client"], stage["dest_folder"])):
+            if client is not None:
+                if errors:
+                    try:
+                        client.logout()
+                    except Exception:
+                        pass
+                else:
+                    get_pool(host, username, password).checkin(client, folder)
+
+def release_replaced_connections(original_source, source_client, original_dest, dest_client, healthy=True):
+    """Control connections the retry layer opened in place of the caller's ones come from the pools, so they go
+    back there, or are logged out after an error; the caller's own connections are left to the caller."""
+    for host, username, password, original, client in ((source_host, source_username, source_password, original_source, source_client),
+                                                       (dest_host, dest_username, dest_password, original_dest, dest_client)):
+        if client is original:
+            continue
+        if healthy:
+            get_pool(host, username, password).checkin(client)
+        else:
+            try:
+                client.logout()
+            except Exception:
+                pass
+
+def transfer_folders(source_client, dest_client, folder_pairs, workers=TRANSFER_WORKERS, journal=None, incremental=False, move=False,
+                     max_connections_per_host=MAX_CONNECTIONS_PER_HOST):
+    """Copy every (source, destination) folder pair using a pool of worker connections.
+    UID ranges of each folder are spread over the workers, so several folders and several ranges
+    of a large folder are copied at the same time. When source and destination are the same account
+    the folders are copied on the server instead (moved, if *move* is set). After a complete run the
+    folders' watermarks are saved to the journal for the next incremental sync; a message that had to be
+    skipped holds its folder's watermark back, so the next run tries it again. Returns the per-folder statistics."""
+    if is_same_account(source_host, source_username, dest_host, dest_username):
+        return copy_folders_on_server(source_client, dest_client, folder_pairs, journal, incremental, move)
+
+    workers = plan_worker_count(workers, source_host, dest_host, max_connections_per_host)
+    work_queue = Queue()
+    large_units = []
+    folders = []
+    dest_indexes = {}
+    original_source, original_dest = source_client, dest_client
+    healthy = False
+    try:
+        for src_box, dest_box in folder_pairs:
+            print(f"\nPreparing to move emails from {src_box} to {dest_box}...")
+            folder, work_units, source_client, dest_client = prepare_folder_transfer(source_client, dest_client, src_box, dest_box, workers, journal,
+                                                                                     incremental, dest_indexes)
+            if folder["flag_updates"]:
+                print(f"Updated flags of {folder['flag_updates']} previously copied emails.")
+            if folder["resumed"]:
+                print(f"{folder['resumed']} emails were already copied in a previous run, skipping them.")
+            print(f"Total emails to be copied: {folder['total']}")
+            folders.append(folder)
+            for unit in work_units:
+                if len(unit[1]) == 1 and unit[2].get(unit[1][0], 0) >= LARGE_MESSAGE_BYTES:
+                    large_units.append(unit)
+                else:
+                    work_queue.put(unit)
+        healthy = True
+    finally:
+        release_replaced_connections(original_source, source_client, original_dest, dest_client, healthy)
+    # Large messages are queued after all small ones, so a few huge messages never hold up the rest
+    for unit in large_units:
+        work_queue.put(unit)
+
+    total = sum(folder["total"] for folder in folders)
+    if total > 4000:
+        print("Due to the large quantity of emails, this may take some time. Please wait...")
+
+    lock = threading.Lock()
+    totals = {"transferred": 0, "duplicates": 0, "size": 0}
+    errors = []
+    thread_count = min(workers, work_queue.qsize())
+    if thread_count:
+        # Open the worker connections to both servers at once, with the first folder already selected
+        first_folder = next(folder for folder in folders if folder["total"])
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(get_pool(source_host, source_username, source_password).warm, thread_count, first_folder["src_box"])
+            executor.submit(get_pool(dest_host, dest_username, dest_password).warm, thread_count, first_folder["dest_box"])
+
+    with tqdm(total=total, desc=f"Copying emails ({workers} connections)", unit="email", ncols=100) as pbar:
+        threads = [threading.Thread(target=transfer_worker, args=(work_queue, lock, pbar, totals, errors, journal), daemon=True)
+                   for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    if journal is not None:
+        for folder in folders:
+            # Messages that could not be fetched keep the watermark at the first of them, so an incremental run picks them up again
+            uidnext = folder["uidnext"]
+            if uidnext and folder["skipped"]:
+                uidnext = min(uidnext, *folder["skipped"])
+            journal.save_sync_state(f"{source_username}@{source_host}", folder["src_box"], f"{dest_username}@{dest_host}", folder["dest_box"],
+                                    folder["uidvalidity"], uidnext, folder["highestmodseq"], folder["dest_uidvalidity"], folder["dest_uidnext"])
+
+    print_folder_results(folders)
+    return folders
+
+def copy_folders_on_server(source_client, dest_client, folder_pairs, journal=None, incremental=False, move=False):
+    """Copy every folder pair within one account using server-side UID COPY/MOVE over the existing connection.
+    Returns the per-folder statistics."""
+    if move and not source_client.has_capability('MOVE'):
+        print("The server does not support MOVE, copying the messages instead.")
+        move = False
+    print(f"\nSource and destination are the same account, {'moving' if move else 'copying'} the messages on the server.")
+
+    folders = []
+    dest_indexes = {}
+    original_source, original_dest = source_client, dest_client
+    healthy = False
+    try:
+        with tqdm(total=0, desc="Copying emails (server-side)", unit="email", ncols=100) as pbar:
+            for src_box, dest_box in folder_pairs:
+                print(f"\nPreparing to move emails from {src_box} to {dest_box}...")
+                folder, work_units, source_client, dest_client = prepare_folder_transfer(source_client, dest_client, src_box, dest_box, 1, journal,
+                                                                                         incremental, dest_indexes)
+                if folder["flag_updates"]:
+                    print(f"Updated flags of {folder['flag_updates']} previously copied emails.")
+                if folder["resumed"]:
+                    print(f"{folder['resumed']} emails were already copied in a previous run, skipping them.")
+                print(f"Total emails to be copied: {folder['total']}")
+                folders.append(folder)
+                pbar.total += folder["total"]
+                pbar.refresh()
+                if work_units:
+                    source_client = copy_folder_on_server(source_client, folder, work_units, pbar, journal, move)
+                if journal is not None:
+                    journal.save_sync_state(f"{source_username}@{source_host}", src_box, f"{dest_username}@{dest_host}", dest_box,
+                                            folder["uidvalidity"], folder["uidnext"], folder["highestmodseq"], folder["dest_uidvalidity"], folder["dest_uidnext"])
+        healthy = True
+    finally:
+        release_replaced_connections(original_source, source_client, original_dest, dest_client, healthy)
+
+    print_folder_results(folders)
+    return folders
+
+def print_folder_results(folders):
+    for folder in folders:
+        print(f"\n{folder['transferred']} messages copied from {folder['src_box']} to {folder['dest_box']}.")
+        print(f"{folder['duplicates']} duplicate messages skipped.")
+        if folder["skipped"]:
+            print(f"{len(folder['skipped'])} messages could not be fetched; the next run tries them again.")
+        print(f"Total size of moved emails: {folder['size'] / (1024 * 1024):.2f} MB")
+    ratio = compression_ratio()
+    if ratio:
+        print(f"\nWire compression: IMAP traffic was reduced {ratio:.1f}x.")
+
+def migrate_account(source, dest, mapping=None, aliases=None, exclude=(), auto=True, workers=TRANSFER_WORKERS, incremental=False,
+                    move=False, compression=True, journal_path=TRANSFER_JOURNAL, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                    alias_groups=False):
+    """Copy the mail of one account to another without asking anything: the library entry point behind the
+    batch mode. *source* and *dest* are dicts with host, username and password, and optionally port and ssl
+    for servers that do not listen on 993/143. Folders are matched like in auto mode, or by alias groups as
+    in batch jobs (see match_mailboxes for *mapping*, *aliases*, *exclude*, *auto* and *alias_groups*);
+    mapped destination folders that do not exist are created.
+    The accounts are kept in module globals for the engine, so calls cannot overlap: a call made while
+    another one is running (in another thread) raises RuntimeError. Run migrations one after the other,
+    or in separate processes.
+    Returns the per-folder statistics."""
+    global source_host, source_username, source_password, dest_host, dest_username, dest_password, wire_compression
+    if not migration_lock.acquire(blocking=False):
+        raise RuntimeError("migrate_account is already running in this process; run migrations one after the other or in separate processes")
+    try:
+        source_host, source_username, source_password = source["host"], source["username"], source["password"]
+        dest_host, dest_username, dest_password = dest["host"], dest["username"], dest["password"]
+        wire_compression = compression
+        for account in (source, dest):
+            if account.get("port"):
+                connection_endpoints[account["host"]] = (account["port"], account.get("ssl", account["port"] != 143))
+
+        with connect_imap(source_host, source_username, source_password) as source_client, \
+             connect_imap(dest_host, dest_username, dest_password) as dest_client:
+            matches = match_mailboxes(source_client, dest_client, mapping, aliases, exclude, auto, alias_groups)
             if not matches:
                 print("No matching mailboxes found.")
-                exit()
+                return []
+            existing = {box[-1] for box in dest_client.list_folders()}
+            for _, dest_box in matches:
+                if dest_box not in existing:
+                    print(f"Creating destination mailbox {dest_box}.")
+                    dest_client.create_folder(dest_box)
+                    existing.add(dest_box)
+
+            journal = TransferJournal(journal_path)
+            try:
+                return transfer_folders(source_client, dest_client, matches, workers, journal, incremental, move, max_connections_per_host)
+            finally:
+                journal.close()
+                close_pools()
+    finally:
+        migration_lock.release()
+
+def load_jobs(path):
+    """Read a batch job file (JSON). Returns tuple: (jobs, settings).
+    Every job names a source and a destination account; their passwords are read from the environment
+    variables given as password_env, so the file itself needs no secrets. Values under "defaults" apply to
+    every job that does not set them. Raises ValueError if the file is invalid."""
+    with open(path) as file:
+        config = json.load(file)
+    defaults = config.get("defaults", {})
+    jobs = []
+    names = set()
+    for number, entry in enumerate(config.get("jobs", []), 1):
+        job = {**defaults, **entry}
+        for side in ("source", "dest"):
+            account = dict(job.get(side) or {})
+            if not account.get("host") or not account.get("username"):
+                raise ValueError(f"job {number}: {side} needs a host and a username")
+            if "password" not in account:
+                variable = account.get("password_env")
+                if not variable or variable not in os.environ:
+                    raise ValueError(f"job {number}: set the {side} password in the environment variable named by password_env"
+                                     + (f" ({variable})" if variable else ""))
+                account["password"] = os.environ[variable]
+            job[side] = account
+        job["name"] = re.sub(r'[^\w.@-]', '_', job.get("name") or f"{job['source']['username']}@{job['source']['host']}")
+        if job["name"] in names:
+            raise ValueError(f"job {number}: the name {job['name']} is used twice")
+        names.add(job["name"])
+        job["workers"] = int(job.get("workers", TRANSFER_WORKERS))
+        jobs.append(job)
+    if not jobs:
+        raise ValueError("the job file lists no jobs")
+    settings = {"max_connections": config.get("max_connections", BATCH_MAX_CONNECTIONS),
+                "host_limits": {host.lower(): limit for host, limit in config.get("host_limits", {}).items()}}
+    return jobs, settings
+
+def job_connections(job, workers=None):
+    """Connections a job holds at most, per host: one control connection and one per worker on each side."""
+    workers = job["workers"] if workers is None else workers
+    needs = {}
+    for side in ("source", "dest"):
+        host = job[side]["host"].lower()
+        needs[host] = needs.get(host, 0) + workers + 1
+    return needs
+
+def run_job_process(job, state_dir, results):
+    """Body of a batch job's process: migrate the account with the job's settings, writing all output to the
+    job's log and its metrics next to it, and put the outcome on *results*."""
+    name = job["name"]
+    start = time.monotonic()
+    with open(os.path.join(state_dir, f"{name}.log"), "a") as log:
+        sys.stdout = sys.stderr = log
+        print(f"\n=== {time.strftime('%Y-%m-%d %H:%M:%S')} {job['source']['username']}@{job['source']['host']} -> "
+              f"{job['dest']['username']}@{job['dest']['host']} ({job['workers']} workers)")
+        metrics.reset("transfer")
+        result = {"name": name, "status": "ok"}
+        try:
+            folders = migrate_account(job["source"], job["dest"], job.get("folders"), job.get("aliases"), job.get("exclude", ()),
+                                      job.get("auto_match", True), job["workers"], job.get("incremental", False), job.get("move", False),
+                                      job.get("compression", True), job.get("journal") or os.path.join(state_dir, f"{name}.journal.db"),
+                                      job["max_connections_per_host"], alias_groups=True)
+            result["folders"] = [{key: value for key, value in folder.items() if key != "message_ids"} for folder in folders]
+        except BaseException as e:
+            traceback.print_exc()
+            result.update(status="failed", error=str(e) or type(e).__name__)
+        finally:
+            write_metrics(os.path.join(state_dir, f"{name}.metrics.json"), os.path.join(state_dir, f"{name}.prom"))
+            log.flush()
+    result["seconds"] = round(time.monotonic() - start, 1)
+    results.put(result)
+
+def run_jobs(jobs, max_connections=BATCH_MAX_CONNECTIONS, host_limits=None, state_dir=BATCH_STATE_DIR):
+    """Run batch jobs side by side, one process each. A job only starts when the connections it needs fit in
+    the global budget and in the limit of every host it uses (MAX_CONNECTIONS_PER_HOST unless *host_limits*
+    says otherwise); a job that has to wait does not hold up smaller ones behind it. Jobs with more workers
+    than could ever fit are given fewer. Returns the results of all jobs, in the order they were listed."""
+    host_limits = host_limits or {}
+
+    def limit(host):
+        return host_limits.get(host, MAX_CONNECTIONS_PER_HOST)
+
+    def fits(needs, in_use, total):
+        return total + sum(needs.values()) <= max_connections and all(in_use.get(host, 0) + count <= limit(host) for host, count in needs.items())
+
+    for job in jobs:
+        workers = job["workers"]
+        while workers > 1 and not fits(job_connections(job, workers), {}, 0):
+            workers -= 1
+        if not fits(job_connections(job, workers), {}, 0):
+            raise ValueError(f"job {job['name']} needs more connections than the limits allow")
+        if workers != job["workers"]:
+            print(f"{job['name']}: using {workers} workers instead of {job['workers']} to stay within the connection limits.")
+        job["workers"] = workers
+        job["max_connections_per_host"] = min(limit(host) for host in job_connections(job))
+
+    os.makedirs(state_dir, exist_ok=True)
+    results = multiprocessing.Queue()
+    pending = list(jobs)
+    running = {}  # name: (job, process)
+    in_use = {}
+    total = 0
+    finished = {}
+    try:
+        while pending or running:
+            for job in list(pending):
+                needs = job_connections(job)
+                if fits(needs, in_use, total):
+                    process = multiprocessing.Process(target=run_job_process, args=(job, state_dir, results), daemon=True)
+                    process.start()
+                    running[job["name"]] = (job, process)
+                    pending.remove(job)
+                    for host, count in needs.items():
+                        in_use[host] = in_use.get(host, 0) + count
+                    total += sum(needs.values())
+                    print(f"Started {job['name']} ({job['source']['host']} -> {job['dest']['host']}, {job['workers']} workers); "
+                          f"{len(running)} running, {len(pending)} waiting")
+
+            try:
+                result = results.get(timeout=1)
+            except Empty:
+                # A process that died without reporting (killed, out of memory) counts as failed
+                result = next(({"name": name, "status": "failed", "error": f"process exited with code {process.exitcode}"}
+                               for name, (_, process) in running.items() if not process.is_alive() and results.empty()), None)
+                if result is None:
+                    continue
+
+            job, process = running.pop(result["name"])
+            process.join()
+            for host, count in job_connections(job).items():
+                in_use[host] -= count
+            total -= sum(job_connections(job).values())
+            finished[job["name"]] = result
+            if result["status"] == "ok":
+                folders = result["folders"]
+                print(f"Finished {job['name']} in {result['seconds']}s: {sum(folder['transferred'] for folder in folders)} copied, "
+                      f"{sum(folder['duplicates'] for folder in folders)} duplicates, "
+                      f"{sum(folder['size'] for folder in folders) / (1024 * 1024):.2f} MB ({len(finished)}/{len(jobs)} done)")
+            else:
+                print(f"FAILED {job['name']}: {result['error']} (see {os.path.join(state_dir, job['name'] + '.log')})")
+    except KeyboardInterrupt:
+        for _, process in running.values():
+            process.terminate()
+        print("\nInterrupted. Run the same jobs again to resume where they stopped.")
+        raise
+
+    return [finished[job["name"]] for job in jobs]
+
+def cli(argv=None):
+    """Command line entry point: without arguments the interactive guide runs, with --jobs the batch mode."""
+    parser = argparse.ArgumentParser(description="Transfer, back up and restore IMAP mailboxes. Without arguments an interactive guide starts.")
+    parser.add_argument("--jobs", help="JSON file listing the accounts to migrate (see the README); runs them without prompts")
+    parser.add_argument("--only", action="append", metavar="NAME", help="run only the job with this name (can be repeated)")
+    parser.add_argument("--max-connections", type=int, help=f"connections all running jobs may hold together (default {BATCH_MAX_CONNECTIONS})")
+    parser.add_argument("--state-dir", default=BATCH_STATE_DIR, help=f"folder for the journals, metrics and logs of the jobs (default {BATCH_STATE_DIR})")
+    args = parser.parse_args(argv)
+
+    if not args.jobs:
+        main()
+        return
 
-            for src_box, dest_box in matches:
-                print(f"\nMoving emails from {src_box} to {dest_box}...")
-                source_client.select_folder(src_box)
-                dest_client.select_folder(dest_box)
-
-                # Fetch all message IDs from source mailbox
-                source_messages = source_client.search('ALL')
-
-                # Fetch all message IDs from destination mailbox
-                dest_messages = dest_client.search('ALL')
-
-                # Get the message IDs already present in the destination mailbox
-                dest_message_ids = set(dest_messages)
-
-                # Filter out the already transferred messages from the source mailbox
-                messages = [msg_id for msg_id in source_messages if msg_id not in dest_message_ids]
-
-                print(f"Total emails to be copied: {len(messages)}")
-
-                if len(messages) > 4000:
-                    print("Due to the large quantity of emails, this may take some time. Please wait...")
-
-                transferred_count = 0
-                duplicate_count = 0
-                total_size = 0
-
-                with tqdm(total=len(messages), desc="Copying emails", unit="email", ncols=80) as pbar:
-                    for idx, msg_id in enumerate(messages):
-                        # Keep connection alive every 50 emails
-                        if idx > 0 and idx % 50 == 0:
-                            try:
-                                source_client.noop()
-                                dest_client.noop()
-                            except:
-                                pass
-
-                        # Fetch message data from source mailbox
-                        response, source_client = safe_fetch(source_client, source_host, source_username, source_password, src_box, msg_id, ['BODY.PEEK[]', 'FLAGS', 'RFC822.SIZE'])
-                        raw_message = response[msg_id][b'BODY[]']
-                        message = message_from_bytes(raw_message)
-                        flags = response[msg_id][b'FLAGS']
-                        size = response[msg_id][b'RFC822.SIZE']
-                        total_size += size
-
-                        # Check if the message is already present in the destination mailbox
-                        message_id = message['Message-ID'].strip() if message['Message-ID'] else ''
-                        if message_id:
-                            try:
-                                dest_search, dest_client = safe_search(dest_client, dest_host, dest_username, dest_password, dest_box, ['HEADER', 'Message-ID', message_id])
-                            except Exception as e:
-                                print(f"\nWarning: Could not check for duplicates: {e}. Proceeding with append...")
-                                dest_search = []
-                        else:
-                            dest_search = []
-
-                        if dest_search:
-                            duplicate_count += 1
-                        else:
-                            filtered_flags = filter_flags_for_append(flags)
-                            _, dest_client = safe_append(dest_client, dest_host, dest_username, dest_password, dest_box, dest_box, message.as_bytes(), flags=filtered_flags)
-                            transferred_count += 1
-
-                        pbar.set_postfix({"Size moved:": f"{total_size / (1024 * 1024):.2f} MB"})
-                        pbar.update(1)
-
-                print(f"\n{transferred_count} messages copied from {src_box} to {dest_box}.")
-                print(f"{duplicate_count} duplicate messages skipped.")
-                print(f"Total size of moved emails: {total_size / (1024 * 1024):.2f} MB")
+    try:
+        jobs, settings = load_jobs(args.jobs)
+    except (OSError, ValueError) as e:
+        parser.error(f"{args.jobs}: {e}")
+    if args.only:
+        jobs = [job for job in jobs if job["name"] in args.only]
+        if not jobs:
+            parser.error("none of the jobs given with --only are in the job file")
+
+    print(f"Running {len(jobs)} jobs; logs, journals and metrics go to {args.state_dir}/")
+    try:
+        results = run_jobs(jobs, args.max_connections or settings["max_connections"], settings["host_limits"], args.state_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    with open(os.path.join(args.state_dir, "summary.json"), "w") as file:
+        json.dump(results, file, indent=2)
+
+    failed = [result["name"] for result in results if result["status"] != "ok"]
+    print(f"\n{len(results) - len(failed)} of {len(results)} jobs finished. Summary written to {os.path.join(args.state_dir, 'summary.json')}")
+    if failed:
+        print(f"Failed jobs: {', '.join(failed)}. Run them again to resume (e.g. with --only).")
+        sys.exit(1)
+
+def main():
+    """Interactive entry point: ask what to do and for the account details, then transfer, back up or restore."""
+    global source_host, source_username, source_password, dest_host, dest_username, dest_password, wire_compression
+
+    # Backup option
+    backup_option = input("Choose an option:\n1. Transfer emails\n2. Backup emails\n3. Restore emails\nEnter your choice: ")
+    while backup_option not in ['1', '2', '3']:
+        print("Invalid choice, please try again.")
+        backup_option = input("Choose an option:\n1. Transfer emails\n2. Backup emails\n3. Restore emails\nEnter your choice: ")
+    metrics.reset({"1": "transfer", "2": "backup", "3": "restore"}[backup_option])
+
+    # Source account details
+    if backup_option == '1':
+        source_host = input("Enter the source host (IMAP server): ")
+        source_username = input("Enter the source username: ")
+        source_password = getpass("Enter the source password: ")
+    elif backup_option == '2':
+        source_host = input("Enter the source host (IMAP server): ")
+        source_username = input("Enter the source username: ")
+        source_password = getpass("Enter the source password: ")
+    else:
+        pass
+
+    # Destination account details if transfer option is chosen
+    if backup_option == '1':
+        dest_host = input("Enter the destination host (IMAP server): ")
+        dest_username = input("Enter the destination username: ")
+        dest_password = getpass("Enter the destination password: ")
 
-        else:
-            source_mailbox = choose_mailbox(source_client, "Source mailboxes:")
-            dest_mailbox = choose_mailbox(dest_client, "Destination mailboxes:")
-
-            source_client.select_folder(source_mailbox)
-            dest_client.select_folder(dest_mailbox)
-
-            # Fetch all message IDs from source mailbox
-            source_messages = source_client.search('ALL')
-
-            print(f"\nTotal emails to be copied: {len(source_messages)}")
-
-            transferred_count = 0
-            duplicate_count = 0
-            total_size = 0
-
-            with tqdm(total=len(source_messages), desc="Copying emails", unit="email", ncols=80) as pbar:
-                for idx, msg_id in enumerate(source_messages):
-                    # Keep connection alive every 50 emails
-                    if idx > 0 and idx % 50 == 0:
-                        try:
-                            source_client.noop()
-                            dest_client.noop()
-                        except:
-                            pass
-
-                    # Fetch message data from source mailbox
-                    response, source_client = safe_fetch(source_client, source_host, source_username, source_password, source_mailbox, msg_id, ['BODY.PEEK[]', 'FLAGS', 'RFC822.SIZE'])
-                    raw_message = response[msg_id][b'BODY[]']
-                    message = message_from_bytes(raw_message)
-                    flags = response[msg_id][b'FLAGS']
-                    size = response[msg_id][b'RFC822.SIZE']
-                    total_size += size
-
-                    # Check if the message is already present in the destination mailbox
-                    message_id = message['Message-ID'].strip() if message['Message-ID'] else ''
-                    if message_id:
-                        try:
-                            dest_search, dest_client = safe_search(dest_client, dest_host, dest_username, dest_password, dest_mailbox, ['HEADER', 'Message-ID', message_id])
-                        except Exception as e:
-                            print(f"\nWarning: Could not check for duplicates: {e}. Proceeding with append...")
-                            dest_search = []
-                    else:
-                        dest_search = []
-
-                    if dest_search:
-                        duplicate_count += 1
-                    else:
-                        filtered_flags = filter_flags_for_append(flags)
-                        _, dest_client = safe_append(dest_client, dest_host, dest_username, dest_password, dest_mailbox, dest_mailbox, message.as_bytes(), flags=filtered_flags)
-                        transferred_count += 1
-
-                    pbar.set_postfix({"Transferred": transferred_count, "Duplicates": duplicate_count,
-                                      "Total Size": f"{total_size / (1024 * 1024):.2f} MB"})
-                    pbar.update(1)
+    # Wire compression pays off on slow links; on a fast local network it only costs CPU time
+    wire_compression = input("Compress IMAP traffic when the server supports it (COMPRESS=DEFLATE)? (y/n, default y): ").lower().strip() != "n"
 
-            print(f"\n{transferred_count} messages copied from {source_mailbox} to {dest_mailbox}.")
-            print(f"{duplicate_count} duplicate messages skipped.")
-            print(f"Total size of moved emails: {total_size / (1024 * 1024):.2f} MB")
-
-        # Summary
-        print("\n--- Summary ---")
-        if auto_move:
-            for src_box, dest_box in matches:
-                print(f"Moved from Source {src_box} to Destination {dest_box}:")
-                print(f"  - Emails moved: {transferred_count}")
-                print(f"  - Duplicate messages skipped: {duplicate_count}")
-                print(f"  - Total size: {total_size / (1024 * 1024):.2f} MB")
-                print()
-        else:
-            print(f"Moved from Source {source_mailbox} to Destination {dest_mailbox}:")
-            print(f"  - Emails moved: {transferred_count}")
-            print(f"  - Duplicate messages skipped: {duplicate_count}")
-            print(f"  - Total size: {total_size / (1024 * 1024):.2f} MB")
+    # Prepare backup file if backup option is chosen
+    if backup_option == '2':
+        backup_filename = f"email_backup_{time.strftime('%Y%m%d-%H%M%S')}.zip"
+        backup_mailboxes = []
 
-elif backup_option == '2':
+    if backup_option == '1':
+        # Connect to the servers
+        with connect_imap(source_host, source_username, source_password) as source_client, \
+             connect_imap(dest_host, dest_username, dest_password) as dest_client:
 
-    # Connect to the source server for backup
-    with connect_imap(source_host, source_username, source_password) as source_client:
-        # Get the list of source mailboxes
-        source_mailboxes = [box[-1] for box in source_client.list_folders()]
+            auto_move = input("Do you want to automatically match mailboxes and move emails? (y/n): ").lower().strip() == "y"
 
-        # Select specific mailboxes for backup
-        print("\nSelect the mailboxes to backup:")
-        for i, mailbox in enumerate(source_mailboxes, 1):
-            print(f"{i}. {mailbox}")
-        print("Enter the mailbox numbers to backup (comma-separated): ")
-        choices = input("Choose mailboxes: ").split(",")
-        for choice in choices:
-            choice = choice.strip()
-            if choice.isdigit() and 1 <= int(choice) <= len(source_mailboxes):
-                backup_mailboxes.append(source_mailboxes[int(choice) - 1])
+            if auto_move:
+                matches = match_mailboxes(source_client, dest_client)
+                if not matches:
+                    print("No matching mailboxes found.")
+                    exit()
             else:
-                print(f"Invalid choice: {choice}. Skipping.")
+                source_mailbox = choose_mailbox(source_client, "Source mailboxes:")
+                dest_mailbox = choose_mailbox(dest_client, "Destination mailboxes:")
+                matches = [(source_mailbox, dest_mailbox)]
+
+            workers = input(f"Number of parallel connections per server (default {TRANSFER_WORKERS}): ").strip()
+            workers = int(workers) if workers.isdigit() and int(workers) > 0 else TRANSFER_WORKERS
+
+            incremental = input("Only sync messages that are new or changed since the last run? (y/n): ").lower().strip() == "y"
+
+            # Within one account the messages are copied on the server; moving them is only done on request
+            move = False
+            if is_same_account(source_host, source_username, dest_host, dest_username):
+                move = input("Source and destination are the same account. Move the emails instead of copying them "
+                             "(removes them from the source folders, including messages the destination already has)? (y/n): ").lower().strip() == "y"
+
+            journal = TransferJournal()
+            try:
+                folders = transfer_folders(source_client, dest_client, matches, workers, journal, incremental, move)
+            finally:
+                journal.close()
+                close_pools()
+                write_metrics()
+
+            # Summary
+            print("\n--- Summary ---")
+            for folder in folders:
+                print(f"Moved from Source {folder['src_box']} to Destination {folder['dest_box']}:")
+                print(f"  - Emails moved: {folder['transferred']}")
+                print(f"  - Duplicate messages skipped: {folder['duplicates']}")
+                print(f"  - Already copied in a previous run: {folder['resumed']}")
+                print(f"  - Flag changes synced: {folder['flag_updates']}")
+                print(f"  - Total size: {folder['size'] / (1024 * 1024):.2f} MB")
+                print()
 
-        if not backup_mailboxes:
-            print("No mailboxes selected for backup. Exiting.")
-            exit()
+    elif backup_option == '2':
 
-        # Connect to the source server again to perform backup
+        # Connect to the source server for backup
         with connect_imap(source_host, source_username, source_password) as source_client:
+            # Get the list of source mailboxes
+            source_mailboxes = [box[-1] for box in source_client.list_folders()]
+
+            # Select specific mailboxes for backup
+            print("\nSelect the mailboxes to backup:")
+            for i, mailbox in enumerate(source_mailboxes, 1):
+                print(f"{i}. {mailbox}")
+            print("Enter the mailbox numbers to backup (comma-separated): ")
+            choices = input("Choose mailboxes: ").split(",")
+            for choice in choices:
+                choice = choice.strip()
+                if choice.isdigit() and 1 <= int(choice) <= len(source_mailboxes):
+                    backup_mailboxes.append(source_mailboxes[int(choice) - 1])
+                else:
+                    print(f"Invalid choice: {choice}. Skipping.")
+
+            if not backup_mailboxes:
+                print("No mailboxes selected for backup. Exiting.")
+                exit()
+
             print(f"\nBacking up {len(backup_mailboxes)} mailboxes...")
 
-            backup_filename = "email_backup.zip"
-            
-            # Set the password for the zip file
-            password = getpass("Enter a password for the backup file: ")
+            # Offer to build on an earlier backup, so only messages missing from it are downloaded and stored
+            base_files = [file for file in sorted(os.listdir()) if file.endswith(".zip") and is_manifest_backup(file)]
+            base_file = None
+            if base_files:
+                print("\nEarlier backups this backup can build on (incremental backup):")
+                for i, file in enumerate(base_files, 1):
+                    print(f"{i}. {file}")
+                choice = input("Choose a backup to build on (by number), or press Enter for a full backup: ").strip()
+                if choice.isdigit() and 1 <= int(choice) <= len(base_files):
+                    base_file = base_files[int(choice) - 1]
 
-            with pyzipper.AESZipFile(backup_filename, "w", compression=zipfile.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as backup_zip:
+            # Set the password for the zip file
+            if base_file:
+                password = getpass("Enter the password of the earlier backup (it is used for this backup too): ")
+            else:
+                password = getpass("Enter a password for the backup file: ")
+
+            compresslevel = input(f"Compression level (0 = store only, 1-9, default {BACKUP_COMPRESSION_LEVEL}): ").strip()
+            compresslevel = int(compresslevel) if compresslevel.isdigit() and int(compresslevel) <= 9 else BACKUP_COMPRESSION_LEVEL
+
+            # Collect what the chain of earlier backups already holds
+            known_messages = {}
+            known_message_ids = {}
+            stored_objects = set()
+            if base_file:
+                try:
+                    with BackupChain(base_file, password.encode()) as chain:
+                        for mailbox, entries in chain.mailboxes().items():
+                            known_messages[mailbox] = {(entry.get("uidvalidity"), entry.get("uid")) for entry in entries}
+                            known_message_ids[mailbox] = {entry["message_id"]: entry for entry in entries if entry.get("message_id") and "segments" in entry}
+                        stored_objects = set(chain.objects)
+                except (OSError, RuntimeError, zipfile.BadZipFile) as e:
+                    print(f"Could not read the earlier backup {base_file}: {e}")
+                    exit()
+
+            with pyzipper.AESZipFile(backup_filename, "w", compression=zipfile.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as backup_zip, \
+                 ParallelArchiveWriter(backup_zip, password.encode(), compresslevel=compresslevel) as backup_writer:
                 backup_zip.setpassword(password.encode())
 
                 backup_count = 0
+                skipped_count = 0
+                backup_bytes = 0
+                stored_bytes = 0
+                manifest = {"format": BACKUP_FORMAT, "parent": os.path.basename(base_file) if base_file else None,
+                            "created": time.strftime('%Y-%m-%dT%H:%M:%S'), "mailboxes": {}}
 
                 for mailbox in tqdm(backup_mailboxes, desc="Backing up mailboxes", ncols=80):
-                    source_client.select_folder(mailbox)
-
-                    # Fetch all message IDs from the mailbox
-                    messages = source_client.search('ALL')
-
-                    # Fetch the full message data for the messages
-                    response = source_client.fetch(messages, ['BODY.PEEK[]'])
-
-                    for msgid, data in response.items():
+                    with metrics.timer("search", mailbox):
+                        select_info = source_client.select_folder(mailbox)
+                        # Fetch all message IDs from the mailbox, leaving out those the earlier backups already hold
+                        messages = source_client.search('ALL')
+                    uidvalidity = select_info.get(b'UIDVALIDITY')
+                    entries = manifest["mailboxes"].setdefault(mailbox, {"uidvalidity": uidvalidity, "messages": []})["messages"]
+
+                    known = known_messages.get(mailbox, set())
+                    remaining = [msg_id for msg_id in messages if (uidvalidity, msg_id) not in known]
+
+                    # If the mailbox was backed up under another UIDVALIDITY, recognise its messages by Message-ID
+                    if remaining and known_message_ids.get(mailbox) and all(value != uidvalidity for value, _ in known):
+                        with metrics.timer("dedup", mailbox):
+                            message_ids, source_client = fetch_message_ids(source_client, source_host, source_username, source_password, mailbox, remaining)
+                        unmatched = []
+                        for msg_id in remaining:
+                            previous = known_message_ids[mailbox].get(message_ids.get(msg_id))
+                            if previous:
+                                entries.append({"uid": msg_id, "message_id": previous["message_id"], "size": previous["size"],
+                                                "segments": previous["segments"], "attachments": previous["attachments"]})
+                            else:
+                                unmatched.append(msg_id)
+                        remaining = unmatched
+                    skipped_count += len(messages) - len(remaining)
+                    metrics.count("messages_already_backed_up", len(messages) - len(remaining), folder=mailbox)
+                    messages = remaining
+
+                    # Fetch the messages in byte-budgeted chunks and write each one before fetching more,
+                    # so memory use does not grow with the size of the folder
+                    with metrics.timer("search", mailbox):
+                        sizes, source_client = fetch_message_sizes(source_client, source_host, source_username, source_password, mailbox, messages)
+                    fetched = iter_fetch_chunks(source_client, source_host, source_username, source_password, mailbox, messages, ['BODY.PEEK[]'], sizes)
+
+                    for msgid, data, source_client in fetched:
+                        if data is None:
+                            continue
                         raw_message = data[b'BODY[]']
-                        message = message_from_bytes(raw_message)
-
-                        # Create an individual .eml file for each email using its ID
-                        folder_name = mailbox.replace("/", "_")  # Replace forward slash with underscore in mailbox name
-                        backup_zip.writestr(f"{folder_name}/{msgid}.eml", raw_message)
-
-                        # Save attachments
-                        for part in message.walk():
-                            if part.get_content_maintype() == "multipart":
-                                continue
-                            if part.get("Content-Disposition") is None:
-                                continue
-
-                            filename = part.get_filename()
-                            if filename:
-                                attachment_data = part.get_payload(decode=True)
-                                backup_zip.writestr(f"{folder_name}/{msgid}_{filename}", attachment_data)
 
+                        # Store the message and its large parts under their content hash; content that is
+                        # already in the archive (the same attachment or message in another folder) is written once
+                        with metrics.timer("parse", mailbox):
+                            segments, attachments = split_message_parts(raw_message)
+                            digests = [hashlib.sha256(segment).hexdigest() for segment in segments]
+                            segment_attachments = {attachment["segment"]: attachment for attachment in attachments}
+                        with metrics.timer("write", mailbox):
+                            for index, (segment, digest) in enumerate(zip(segments, digests)):
+                                if digest not in stored_objects:
+                                    backup_writer.write(f"objects/{digest}", segment, segment_attachments.get(index))
+                                    stored_objects.add(digest)
+                                    stored_bytes += len(segment)
+                                    metrics.count("bytes_stored", len(segment), folder=mailbox)
+
+                        entries.append({"uid": msgid, "message_id": extract_message_id(raw_message), "size": len(raw_message), "segments": digests,
+                                        "attachments": [{"filename": attachment["filename"], "object": digests[attachment["segment"]],
+                                                         "encoding": attachment["encoding"]} for attachment in attachments]})
+                        backup_bytes += len(raw_message)
                         backup_count += 1
+                        metrics.count("messages_backed_up", folder=mailbox)
+
+                # The manifest maps every mailbox and UID to its objects
+                with metrics.timer("write"):
+                    backup_writer.write(BACKUP_MANIFEST, json.dumps(manifest).encode())
 
             print(f"\nBackup created successfully: {backup_filename}")
             print(f"Total emails backed up: {backup_count}")
+            if base_file:
+                print(f"Emails already in earlier backups (not downloaded again): {skipped_count}")
+                print(f"This backup builds on {base_file}; keep the earlier backups next to it to restore.")
+            print(f"Stored {stored_bytes / (1024 * 1024):.2f} MB of unique content for {backup_bytes / (1024 * 1024):.2f} MB of email.")
+            ratio = compression_ratio()
+            if ratio:
+                print(f"Wire compression: IMAP traffic was reduced {ratio:.1f}x.")
             print("The backup file is password protected.")
+            write_metrics()
 
 
 
 
 
-elif backup_option == '3':
-    # Get the list of backup files
-    backup_files = [file for file in os.listdir() if file.endswith(".zip")]
-
-    if not backup_files:
-        print("No backup files found in the current directory.")
-        exit()
-
-    print("Available backup files:")
-    for i, file in enumerate(backup_files, 1):
-        print(f"{i}. {file}")
-
-    choice = input("Choose a backup file (by number): ")
-    if choice.isdigit() and 1 <= int(choice) <= len(backup_files):
-        selected_file = backup_files[int(choice) - 1]
-        print(f"Selected backup file: {selected_file}")
+    elif backup_option == '3':
+        # Get the list of backup files
+        backup_files = [file for file in sorted(os.listdir()) if file.endswith(".zip")]
 
-        # Extract the backup file
-        backup_folder = selected_file.replace(".zip", "")
-        password = getpass("Enter the password for the backup file: ")  # Ask for password
-        with pyzipper.AESZipFile(selected_file, "r", encryption=pyzipper.WZ_AES) as backup_zip:
-            backup_zip.pwd = password.encode()
-            backup_zip.extractall(backup_folder)
-
-        # Get the list of mailbox directories in the backup folder
-        backup_mailboxes = [entry for entry in os.listdir(backup_folder) if os.path.isdir(os.path.join(backup_folder, entry))]
-
-        print("Source mailboxes:")
-        for i, mailbox in enumerate(backup_mailboxes, 1):
-            print(f"{i}. {mailbox}")
-
-        choice = input("Choose source mailboxes to restore (comma-separated numbers): ")
-        selected_indices = choice.split(",")
-        selected_indices = [int(index.strip()) for index in selected_indices if index.strip().isdigit()]
-
-        selected_mailboxes = [backup_mailboxes[index - 1] for index in selected_indices if 1 <= index <= len(backup_mailboxes)]
-
-        if not selected_mailboxes:
-            print("No valid mailboxes selected for restore.")
+        if not backup_files:
+            print("No backup files found in the current directory.")
             exit()
 
-        # Connect to the destination server for restore
-        dest_host = input("Enter the destination host (IMAP server): ")
-        dest_username = input("Enter the destination username: ")
-        dest_password = getpass("Enter the destination password: ")
-
-        with connect_imap(dest_host, dest_username, dest_password) as dest_client:
-            print("Destination mailboxes:")
-            dest_mailboxes = dest_client.list_folders()
-
-            for i, mailbox in enumerate(dest_mailboxes, 1):
-                print(f"{i}. {mailbox}")
-
-            choice = input("Choose destination mailboxes (comma-separated numbers): ")
-            selected_indices = choice.split(",")
-            selected_indices = [int(index.strip()) for index in selected_indices if index.strip().isdigit()]
-
-            selected_dest_mailboxes = [dest_mailboxes[index - 1] for index in selected_indices if 1 <= index <= len(dest_mailboxes)]
-
-            if not selected_dest_mailboxes:
-                print("No valid destination mailboxes selected.")
-                exit()
-
-            for mailbox in selected_mailboxes:
-                print(f"\nRestoring emails from {mailbox} to the selected destination mailboxes...")
-
-                source_folder = os.path.join(backup_folder, mailbox)
+        print("Available backup files:")
+        for i, file in enumerate(backup_files, 1):
+            print(f"{i}. {file}")
+
+        choice = input("Choose a backup file (by number): ")
+        if choice.isdigit() and 1 <= int(choice) <= len(backup_files):
+            selected_file = backup_files[int(choice) - 1]
+            print(f"Selected backup file: {selected_file}")
+
+            # Messages are read straight from the archive, one member at a time, so nothing is
+            # extracted to disk and members that are not restored (other mailboxes) are never decrypted
+            password = getpass("Enter the password for the backup file: ")  # Ask for password
+            with BackupChain(selected_file, password.encode()) as backup_chain:
+                # Index the messages by mailbox, merged over the backup and the earlier backups it builds on
+                backup_members = backup_chain.mailboxes()
+                backup_mailboxes = list(backup_members)
+
+                print("Source mailboxes:")
+                for i, mailbox in enumerate(backup_mailboxes, 1):
+                    print(f"{i}. {mailbox}")
 
-                for dest_mailbox in selected_dest_mailboxes:
-                    print(f"\nRestoring emails to destination mailbox: {dest_mailbox[2]}")  # Extract the mailbox name from the tuple
+                choice = input("Choose source mailboxes to restore (comma-separated numbers): ")
+                selected_indices = choice.split(",")
+                selected_indices = [int(index.strip()) for index in selected_indices if index.strip().isdigit()]
+
+                selected_mailboxes = [backup_mailboxes[index - 1] for index in selected_indices if 1 <= index <= len(backup_mailboxes)]
+
+                if not selected_mailboxes:
+                    print("No valid mailboxes selected for restore.")
+                    exit()
+
+                # Connect to the destination server for restore
+                dest_host = input("Enter the destination host (IMAP server): ")
+                dest_username = input("Enter the destination username: ")
+                dest_password = getpass("Enter the destination password: ")
+
+                with connect_imap(dest_host, dest_username, dest_password) as dest_client:
+                    print("Destination mailboxes:")
+                    dest_mailboxes = dest_client.list_folders()
+
+                    for i, mailbox in enumerate(dest_mailboxes, 1):
+                        print(f"{i}. {mailbox}")
+
+                    choice = input("Choose destination mailboxes (comma-separated numbers): ")
+                    selected_indices = choice.split(",")
+                    selected_indices = [int(index.strip()) for index in selected_indices if index.strip().isdigit()]
+
+                    selected_dest_mailboxes = [dest_mailboxes[index - 1] for index in selected_indices if 1 <= index <= len(dest_mailboxes)]
+
+                    if not selected_dest_mailboxes:
+                        print("No valid destination mailboxes selected.")
+                        exit()
+
+                    dest_indexes = {}
+
+                    for mailbox in selected_mailboxes:
+                        print(f"\nRestoring emails from {mailbox} to the selected destination mailboxes...")
+
+                        for dest_mailbox in selected_dest_mailboxes:
+                            print(f"\nRestoring emails to destination mailbox: {dest_mailbox[2]}")  # Extract the mailbox name from the tuple
+
+                            # Select the destination mailbox
+                            dest_client.select_folder(dest_mailbox[2])  # Select the existing destination mailbox
+
+                            # Index the Message-IDs already present once; appends keep it current afterwards
+                            if dest_mailbox[2] not in dest_indexes:
+                                with metrics.timer("dedup", mailbox):
+                                    dest_indexes[dest_mailbox[2]], dest_client = load_message_id_index(dest_client, dest_host, dest_username, dest_password, dest_mailbox[2])
+                            dest_message_ids = dest_indexes[dest_mailbox[2]]
+
+                            # Message members of the source mailbox in the archive
+                            message_files = backup_members[mailbox]
+
+                            print(f"Total emails to be restored in {mailbox}: {len(message_files)}")
+
+                            if len(message_files) > 4000:
+                                print("Due to the large quantity of emails, this may take some time. Please wait...")
+
+                            transferred_count = 0
+                            duplicate_count = 0
+                            total_size = 0
+
+                            with tqdm(total=len(message_files), desc="Restoring emails", unit="email", ncols=80) as pbar:
+                                for message_file in message_files:
+                                    with metrics.timer("read", mailbox):
+                                        raw_message = backup_chain.read_message(message_file)
+
+                                    flags = None  # You may modify this based on your requirements
+                                    size = message_file["size"]
+                                    total_size += size
+
+                                    # Check if the message is already present in the destination mailbox
+                                    with metrics.timer("parse", mailbox):
+                                        message_id = extract_message_id(raw_message)
+                                    if message_id and message_id in dest_message_ids:
+                                        duplicate_count += 1
+                                        metrics.count("duplicates", folder=mailbox)
+                                    else:
+                                        filtered_flags = filter_flags_for_append(flags) if flags else []
+                                        with metrics.timer("append", mailbox):
+                                            _, dest_client = safe_append(dest_client, dest_host, dest_username, dest_password, dest_mailbox[2], dest_mailbox[2], raw_message, flags=filtered_flags)
+                                        if message_id:
+                                            dest_message_ids.add(message_id)
+                                        transferred_count += 1
+                                        metrics.count("messages_restored", folder=mailbox)
+                                        metrics.count("bytes_appended", size, host=dest_host, folder=mailbox)
+
+                                    postfix = {"Restored": transferred_count, "Duplicates": duplicate_count, "Total Size": f"{total_size / (1024 * 1024):.2f} MB"}
+                                    ratio = compression_ratio()
+                                    if ratio:
+                                        postfix["Compression"] = f"{ratio:.1f}x"
+                                    pbar.set_postfix(postfix)
+                                    pbar.update(1)
 
-                    # Select the destination mailbox
-                    dest_client.select_folder(dest_mailbox[2])  # Select the existing destination mailbox
+                            print(f"\n{transferred_count} messages restored to {dest_mailbox[2]} mailbox {mailbox}.")
+                            print(f"{duplicate_count} duplicate messages skipped.")
+                            print(f"Total size of restored emails in {mailbox}: {total_size / (1024 * 1024):.2f} MB")
 
-                    # Fetch all message files from the source mailbox folder
-                    message_files = [file for file in os.listdir(source_folder) if file.endswith(".eml")]
+                    write_metrics()
 
-                    print(f"Total emails to be restored in {mailbox}: {len(message_files)}")
 
-                    if len(message_files) > 4000:
-                        print("Due to the large quantity of emails, this may take some time. Please wait...")
-
-                    transferred_count = 0
-                    duplicate_count = 0
-                    total_size = 0
-
-                    with tqdm(total=len(message_files), desc="Restoring emails", unit="email", ncols=80) as pbar:
-                        for idx, message_file in enumerate(message_files):
-                            # Keep connection alive every 50 emails
-                            if idx > 0 and idx % 50 == 0:
-                                try:
-                                    dest_client.noop()
-                                except:
-                                    pass
-
-                            with open(os.path.join(source_folder, message_file), "rb") as file:
-                                raw_message = file.read()
-
-                            message = message_from_bytes(raw_message)
-                            flags = None  # You may modify this based on your requirements
-                            size = os.path.getsize(os.path.join(source_folder, message_file))
-                            total_size += size
-
-                            # Check if the message is already present in the destination mailbox
-                            message_id = message['Message-ID'].strip() if message['Message-ID'] else ''
-                            if message_id:
-                                try:
-                                    dest_search, dest_client = safe_search(dest_client, dest_host, dest_username, dest_password, dest_mailbox[2], ['HEADER', 'Message-ID', message_id])
-                                except Exception as e:
-                                    print(f"\nWarning: Could not check for duplicates: {e}. Proceeding with append...")
-                                    dest_search = []
-                            else:
-                                dest_search = []
-
-                            if dest_search:
-                                duplicate_count += 1
-                            else:
-                                filtered_flags = filter_flags_for_append(flags) if flags else []
-                                _, dest_client = safe_append(dest_client, dest_host, dest_username, dest_password, dest_mailbox[2], dest_mailbox[2], raw_message, flags=filtered_flags)
-                                transferred_count += 1
-
-                            pbar.set_postfix(
-                                {"Restored": transferred_count, "Duplicates": duplicate_count, "Total Size": f"{total_size / (1024 * 1024):.2f} MB"}
-                            )
-                            pbar.update(1)
-
-                    print(f"\n{transferred_count} messages restored to {dest_mailbox[2]} mailbox {mailbox}.")
-                    print(f"{duplicate_count} duplicate messages skipped.")
-                    print(f"Total size of restored emails in {mailbox}: {total_size / (1024 * 1024):.2f} MB")
-                    
-            # After the restore process, clean up
-            folder_path = "email_backup"
-            if os.path.exists(folder_path):
-                shutil.rmtree(folder_path)
-                print("The 'email_backup' folder and its contents have been removed.")
-            else:
-                print("The 'email_backup' folder does not exist.")
\ No newline at end of file
+if __name__ == "__main__":
+    cli()